@@ -388,6 +388,11 @@ static void run_script(const char *fname) {
                 die(0, "could not encode Opus data: %s", opus_strerror(plen));
             write_packet(audio_length, plen);
             state = kStateInitial;
+        } else if (strcmp(fields[0], "reset") == 0) {
+            check_args(nfields, 0);
+            if (state != kStateInitial)
+                die(0, "unexpected reset command");
+            opus_encoder_ctl(enc, OPUS_RESET_STATE);
         } else if (strcmp(fields[0], "emit") == 0) {
             check_args(nfields, 1);
             if (state != kStateInitial)
@@ -1,4 +1,7 @@
+import argparse
+import concurrent.futures
 import datetime
+import hashlib
 import io
 import json
 import os
@@ -7,10 +10,12 @@ import shutil
 import struct
 import subprocess
 import sys
-import tempfile
+import time
 import zlib
 
-from typing import List
+from opuscraft import cache
+
+from typing import Any, List, NamedTuple, Optional, Tuple
 
 TIME = datetime.datetime(2018, 9, 13, 13, 0, 0)
 
@@ -80,36 +85,209 @@ def build_html() -> bytes:
     code = data["code"]
     return (HTML + code + "</script>").encode("UTF-8")
 
+# Zopfli iteration counts tried when tuning, in order.
+ZOPFLI_ITERATIONS = [15, 50, 100, 200, 500, 1000, 2000, 5000]
+
+def deflate(fpath: pathlib.Path, data: bytes, setting: str) -> bytes:
+    """Compress a file, returning the raw Deflate stream.
+
+    Arguments:
+      fpath: Path to a copy of the data, for external tools.
+      data: The data to compress.
+      setting: The compressor and its parameters, "zlib-<level>" or
+        "zopfli-i<iterations>".
+    """
+    method, _, param = setting.partition("-")
+    if method == "zlib":
+        obj = zlib.compressobj(int(param), zlib.DEFLATED, -15, 9)
+        return obj.compress(data) + obj.flush()
+    if method == "zopfli":
+        out = subprocess.run(
+            ["zopfli", "-c", "--" + param, "--deflate", str(fpath)],
+            stdout=subprocess.PIPE,
+            check=True,
+        )
+        return out.stdout
+    raise ValueError("unknown compression setting {!r}".format(setting))
+
+def deflate_cache() -> Optional[cache.FileCache]:
+    """Return the cache for compressed files, or None if caching is disabled.
+
+    This is a directory in the opuscraft cache, with the same size limit.
+    """
+    path = cache.cache_dir()
+    if path is None:
+        return None
+    return cache.FileCache(os.path.join(path, "deflate"), cache.cache_limit())
+
+def read_cache(key: str) -> Optional[bytes]:
+    """Return the contents of a cache entry, or None if it does not exist."""
+    dcache = deflate_cache()
+    if dcache is None:
+        return None
+    path = dcache.get(key)
+    if path is None:
+        return None
+    try:
+        with open(path, "rb") as fp:
+            return fp.read()
+    except FileNotFoundError:
+        return None
+
+def write_cache(key: str, data: bytes) -> None:
+    """Add an entry to the cache.
+
+    Each writer uses its own temporary file, so concurrent jobs writing the
+    same entry do not interfere.
+    """
+    dcache = deflate_cache()
+    if dcache is None:
+        return
+    tpath = dcache.temp_path()
+    try:
+        with open(tpath, "wb") as fp:
+            fp.write(data)
+        path = dcache.put(key, tpath)
+    except BaseException:
+        os.remove(tpath)
+        raise
+    dcache.evict(path)
+
+def compress(fpath: pathlib.Path, data: bytes, setting: str) -> bytes:
+    """Compress a file, returning the raw Deflate stream.
+
+    The data must already be written to fpath. Results are cached by the hash
+    of the data and the compression setting.
+    """
+    key = "{}-{}".format(hashlib.sha256(data).hexdigest(), setting)
+    cdata = read_cache(key)
+    if cdata is None:
+        cdata = deflate(fpath, data, setting)
+        write_cache(key, cdata)
+    return cdata
+
+class Trial(NamedTuple):
+    """The result of compressing a file with one setting."""
+    setting: str
+    size: int
+    time: float
+
+def tune(fpath: pathlib.Path, data: bytes,
+         min_gain: int) -> Tuple[bytes, List[Trial]]:
+    """Compress a file with the setting that gives the smallest output.
+
+    This tries zlib, then zopfli with increasing iteration counts, stopping
+    when more iterations save fewer than min_gain bytes. The best setting and
+    the trials are recorded by the hash of the data, so later builds of the
+    same data only compress it once. A record is not reused if zopfli has
+    been installed or removed since it was made.
+
+    Returns:
+      A tuple (cdata, trials) with the compressed data and the trials.
+    """
+    rkey = "{}-tune.json".format(hashlib.sha256(data).hexdigest())
+    have_zopfli = shutil.which("zopfli") is not None
+    record = read_cache(rkey)
+    obj: Any = None
+    if record is not None:
+        try:
+            obj = json.loads(record.decode("UTF-8"))
+        except ValueError:
+            pass
+    if (isinstance(obj, dict) and obj.get("min_gain") == min_gain and
+            obj.get("zopfli") == have_zopfli):
+        trials = [Trial(*trial) for trial in obj["trials"]]
+        return compress(fpath, data, obj["best"]), trials
+    trials = []
+    best: Optional[Tuple[str, bytes]] = None
+    prev: Optional[int] = None
+    settings = ["zlib-9"]
+    if have_zopfli:
+        settings.extend("zopfli-i{}".format(n) for n in ZOPFLI_ITERATIONS)
+    for setting in settings:
+        t0 = time.perf_counter()
+        cdata = compress(fpath, data, setting)
+        trials.append(Trial(setting, len(cdata), time.perf_counter() - t0))
+        if best is None or len(cdata) < len(best[1]):
+            best = setting, cdata
+        if setting.startswith("zopfli"):
+            if prev is not None and prev - len(cdata) < min_gain:
+                break
+            prev = len(cdata)
+    assert best is not None
+    write_cache(rkey, json.dumps({
+        "best": best[0],
+        "min_gain": min_gain,
+        "zopfli": have_zopfli,
+        "trials": trials,
+    }).encode("UTF-8"))
+    return best[1], trials
+
 class File:
-    def __init__(self, name: str, data: bytes, cdata: bytes) -> None:
+    def __init__(self, name: str, data: bytes, cdata: bytes,
+                 trials: List[Trial]) -> None:
         self.name = name
         self.data = data
         self.cdata = cdata
+        self.trials = trials
 
 class FileSet:
     zippath: pathlib.Path
     filepath: pathlib.Path
     files: List[File]
+    pending: List[Tuple[str, bytes,
+                        "concurrent.futures.Future[Tuple[bytes, List[Trial]]]"]]
     body: io.BytesIO
     directory: io.BytesIO
 
-    def __init__(self, zippath: pathlib.Path, filepath: pathlib.Path) -> None:
+    def __init__(self, zippath: pathlib.Path, filepath: pathlib.Path, *,
+                 release: bool = True, min_gain: int = 1) -> None:
+        """Create a new set of files.
+
+        Arguments:
+          release: If true, tune compression settings for the smallest
+            output, otherwise use a fast setting.
+          min_gain: Stop trying more zopfli iterations when they save fewer
+            than this many bytes.
+        """
         self.zippath = zippath
         self.filepath = filepath
+        self.release = release
+        self.min_gain = min_gain
         self.files = []
+        self.pending = []
+        self.executor = concurrent.futures.ThreadPoolExecutor()
         self.body = io.BytesIO()
         self.directory = io.BytesIO()
+        if release and not shutil.which("zopfli"):
+            print("Warning: zopfli not found, compressing with zlib only",
+                  file=sys.stderr)
 
     def add(self, name: str, data: bytes) -> None:
+        """Add a file to the set, compressing it in the background."""
         fpath = self.filepath / name
         fpath.write_bytes(data)
-        out = subprocess.run(
-            ["zopfli", "-c", "--i50", "--deflate", str(fpath)],
-            stdout=subprocess.PIPE,
-            check=True,
-        )
-        cdata = out.stdout
-        self.files.append(File(name, data, cdata))
+        self.pending.append(
+            (name, data, self.executor.submit(self.compress, fpath, data)))
+
+    def compress(self, fpath: pathlib.Path,
+                 data: bytes) -> Tuple[bytes, List[Trial]]:
+        if self.release:
+            return tune(fpath, data, self.min_gain)
+        t0 = time.perf_counter()
+        cdata = compress(fpath, data, "zlib-9")
+        return cdata, [Trial("zlib-9", len(cdata), time.perf_counter() - t0)]
+
+    def finish(self) -> None:
+        """Wait for all files to be compressed and add them to the archive."""
+        for name, data, future in self.pending:
+            self.add_compressed(name, data, *future.result())
+        self.pending.clear()
+        self.executor.shutdown()
+
+    def add_compressed(self, name: str, data: bytes, cdata: bytes,
+                       trials: List[Trial]) -> None:
+        self.files.append(File(name, data, cdata, trials))
         bname = name.encode("ASCII")
         pos = self.body.tell()
         crc = zlib.crc32(data)
@@ -152,8 +330,9 @@ class FileSet:
         ))
         self.directory.write(bname)
 
-    def save(self) -> None:
-        end = struct.pack(
+    def end_record(self) -> bytes:
+        """Return the end of central directory record."""
+        return struct.pack(
             "<IHHHHIIH",
             0x06054b50,
             0, # multi-disk
@@ -164,6 +343,10 @@ class FileSet:
             self.body.tell(), # directory offset
             0, # comment length
         )
+
+    def save(self) -> None:
+        self.finish()
+        end = self.end_record()
         with self.zippath.open("wb") as fp:
             fp.write(self.body.getvalue())
             fp.write(self.directory.getvalue())
@@ -176,21 +359,102 @@ class FileSet:
             print_size(len(file.cdata), file.name)
         print_size(overhead, "ZIP overhead")
         print_size(zipsize, "Total")
+        print(file=sys.stderr)
+        print("    Size (B)  Time (s)  Setting", file=sys.stderr)
+        for file in self.files:
+            print("  {}:".format(file.name), file=sys.stderr)
+            for trial in file.trials:
+                mark = "*" if trial.size == len(file.cdata) else " "
+                print("    {:8}  {:8.2f}  {}{}".format(
+                    trial.size, trial.time, trial.setting, mark),
+                      file=sys.stderr)
 
     def test(self) -> None:
-        with tempfile.TemporaryDirectory("angstrom") as d:
-            subprocess.run(
-                ['unzip', str(self.zippath)],
-                cwd=d,
-                check=True,
-            )
-            for file in self.files:
-                data = pathlib.Path(d, file.name).read_bytes()
-                if data != file.data:
-                    print("error: data mismatch (file={!r})".format(file.name))
-                    raise SystemExit(1)
+        """Check that the archive decompresses to the original files.
+
+        This parses the archive from the assembled buffers and checks every
+        header field, and that each file inflates to the original data.
+        """
+        try:
+            self.check()
+        except ValueError as ex:
+            print("error: {}".format(ex))
+            raise SystemExit(1)
+
+    def check(self) -> None:
+        body = self.body.getvalue()
+        directory = self.directory.getvalue()
+        end = self.end_record()
+        if end[:4] != b"PK\x05\x06":
+            raise ValueError("bad end record signature")
+        (_, _, _, count1, count2, dirsize, diroffset, _) = struct.unpack(
+            "<IHHHHIIH", end)
+        if count1 != len(self.files) or count2 != len(self.files):
+            raise ValueError("bad directory entry count")
+        if dirsize != len(directory) or diroffset != len(body):
+            raise ValueError("bad directory location")
+        dirpos = 0
+        bodypos = 0
+        dirfields = struct.Struct("<IHHHHHHIIIHHHHHII")
+        localfields = struct.Struct("<IHHHHHIIIHH")
+        for file in self.files:
+            bname = file.name.encode("ASCII")
+            (sig, _, version, flags, method, mtime, mdate, crc, csize, size,
+             namelen, extralen, commentlen, _, _, _, offset) = \
+                dirfields.unpack_from(directory, dirpos)
+            dirpos += dirfields.size
+            name = directory[dirpos:dirpos+namelen]
+            dirpos += namelen + extralen + commentlen
+            if sig != 0x02014b50:
+                raise ValueError("bad directory entry signature (file={!r})"
+                                 .format(file.name))
+            if name != bname:
+                raise ValueError("name mismatch (file={!r})"
+                                 .format(file.name))
+            if offset != bodypos:
+                raise ValueError("bad local header offset (file={!r})"
+                                 .format(file.name))
+            local = localfields.unpack_from(body, offset)
+            if local != (0x04034b50, version, flags, method, mtime, mdate,
+                         crc, csize, size, namelen, 0):
+                raise ValueError("local header mismatch (file={!r})"
+                                 .format(file.name))
+            pos = offset + localfields.size
+            if body[pos:pos+namelen] != bname:
+                raise ValueError("local name mismatch (file={!r})"
+                                 .format(file.name))
+            pos += namelen
+            if method != 8:
+                raise ValueError("bad compression method (file={!r})"
+                                 .format(file.name))
+            obj = zlib.decompressobj(-15)
+            try:
+                data = obj.decompress(body[pos:pos+csize])
+            except zlib.error as ex:
+                raise ValueError("{} (file={!r})".format(ex, file.name))
+            if not obj.eof or obj.unused_data:
+                raise ValueError("bad compressed data length (file={!r})"
+                                 .format(file.name))
+            if len(data) != size or zlib.crc32(data) != crc:
+                raise ValueError("size or CRC mismatch (file={!r})"
+                                 .format(file.name))
+            if data != file.data:
+                raise ValueError("data mismatch (file={!r})"
+                                 .format(file.name))
+            bodypos = pos + csize
+        if dirpos != len(directory):
+            raise ValueError("extra data in directory")
+        if bodypos != len(body):
+            raise ValueError("extra data in body")
 
 def main() -> None:
+    p = argparse.ArgumentParser()
+    p.add_argument("--dev", action="store_true",
+                   help="compress quickly instead of tuning for size")
+    p.add_argument("--min-gain", type=int, default=1,
+                   help="stop tuning when zopfli saves fewer bytes than this")
+    args = p.parse_args()
+
     print("Building", file=sys.stderr)
     html = build_html()
 
@@ -203,7 +467,8 @@ def main() -> None:
     builddir.mkdir(parents=True)
     filedir = builddir / "files"
     filedir.mkdir()
-    fs = FileSet(builddir / "js13k.zip", filedir)
+    fs = FileSet(builddir / "js13k.zip", filedir,
+                 release=not args.dev, min_gain=args.min_gain)
     fs.add("index.html", html)
     fs.add("audio.opus",
            (ROOT_DIR / "game/cyber/audio/audio.opus").read_bytes())
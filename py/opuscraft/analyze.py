@@ -1,9 +1,67 @@
+import concurrent.futures
+import functools
 import math
+import os
 import sys
 
 import numpy
-import scipy.fftpack
-import scipy.signal
+
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+# Range of periods detected by get_period, in samples.
+PERIOD_MIN = 360
+PERIOD_MAX = 600
+
+# Number of positions get_periods analyzes at a time. This limits the size of
+# the temporary arrays.
+PERIOD_CHUNK = 64
+
+@functools.lru_cache()
+def blackman_window(length: int) -> numpy.ndarray:
+    """Return a Blackman window, cached for reuse.
+
+    This is computed the same way as scipy.signal.windows.blackman, which is
+    slow to import.
+    """
+    fac = numpy.linspace(-math.pi, math.pi, length)
+    window = 0.42 + 0.5 * numpy.cos(fac) + 0.08 * numpy.cos(2 * fac)
+    window.flags.writeable = False
+    return window
+
+def get_periods(data: numpy.ndarray,
+                positions: Sequence[int]) -> numpy.ndarray:
+    """Return the periods of pitched audio at several positions.
+
+    This computes the same autocorrelation as get_period, but for
+    PERIOD_CHUNK positions at a time, using FFT-based correlation.
+
+    Arguments:
+      data: The audio data, in float32 format.
+      positions: The sample positions in the audio to analyze pitch.
+    """
+    tmax = PERIOD_MAX
+    pos = numpy.asarray(positions, dtype=numpy.intp).reshape(-1)
+    if not numpy.all((tmax*3 < pos) & (pos < len(data) - tmax*3)):
+        raise ValueError("Position out of range")
+    # The windowed audio is correlated with the neighborhood at offsets up to
+    # tmax in either direction. The neighborhood is exactly long enough that
+    # a circular correlation of that length does not wrap around.
+    nfft = tmax * 6
+    window = blackman_window(tmax * 4)
+    offsets = numpy.arange(-tmax*3, tmax*3)
+    lags = numpy.arange(PERIOD_MIN, PERIOD_MAX)
+    result = numpy.zeros(len(pos), dtype=int)
+    for i in range(0, len(pos), PERIOD_CHUNK):
+        cpos = pos[i:i+PERIOD_CHUNK]
+        neighborhood = data[cpos[:,None] + offsets].astype(numpy.float64)
+        windowed = neighborhood[:,tmax:tmax*5] * window
+        corr = numpy.fft.irfft(
+            numpy.fft.rfft(windowed, nfft, axis=1).conj() *
+            numpy.fft.rfft(neighborhood, axis=1),
+            nfft, axis=1)
+        corr = corr[:,tmax+lags] + corr[:,tmax-lags]
+        result[i:i+PERIOD_CHUNK] = numpy.argmax(corr, axis=1) + PERIOD_MIN
+    return result
 
 def get_period(data: numpy.ndarray, pos: int) -> int:
     """Return the period of pitched audio.
@@ -15,26 +73,7 @@ def get_period(data: numpy.ndarray, pos: int) -> int:
       data: The audio data, in float32 format.
       pos: The sample position in the audio to analyze pitch.
     """
-    tmax = 600
-    if not (tmax*3 < pos < len(data) - tmax*3):
-        raise ValueError("Position out of range")
-    windowed = (data[pos-tmax*2:pos+tmax*2] *
-                scipy.signal.windows.blackman(tmax * 4))
-    neighborhood = data[pos-tmax*3:pos+tmax*3]
-    corr = scipy.signal.convolve(windowed, neighborhood[::-1])
-    lcorr = corr[:tmax*5]
-    rcorr = corr[tmax*5-1:]
-    corr = rcorr + lcorr[::-1]
-    i0 = 360
-    i1 = 600
-    return int(numpy.argmax(corr[i0:i1])) + i0
-
-def extract_clip(data: numpy.ndarray, pos: int, length: int) -> numpy.ndarray:
-    """Extract a section of an audio array."""
-    end = pos + length
-    if not (0 <= pos <= end <= len(data)):
-        raise ValueError("Position out of range")
-    return data[pos:end]
+    return int(get_periods(data, [pos])[0])
 
 def extract_looped(data: numpy.ndarray,
                    pos: int, length: int, overlap: int) -> numpy.ndarray:
@@ -43,41 +82,149 @@ def extract_looped(data: numpy.ndarray,
     The loop is made by extracting some extra audio around the selected range
     and blending it.
     """
-    i0 = pos - overlap//2
-    i1 = i0 + length + overlap
-    if not (0 <= i0 <= i1 <= len(data)):
+    return extract_looped_many(data, [pos], length, overlap)[0]
+
+def extract_looped_many(data: numpy.ndarray,
+                        positions: Union[Sequence[int], numpy.ndarray],
+                        length: int, overlap: int) -> numpy.ndarray:
+    """Extract several sections of audio with the same length as loops.
+
+    Returns:
+      An array with one loop in each row.
+    """
+    i0 = numpy.asarray(positions, dtype=numpy.intp).reshape(-1) - overlap//2
+    width = length + overlap
+    if len(i0) and not (0 <= i0.min() and i0.max() + width <= len(data)):
         raise ValueError("Position out of range")
-    clip = numpy.roll(data[i0:i1], overlap)
-    clip[:overlap*2] *= numpy.cos(
+    if not len(i0):
+        return numpy.zeros((0, length), data.dtype)
+    windows = numpy.lib.stride_tricks.as_strided(
+        data, (len(data) - width + 1, width), data.strides * 2,
+        writeable=False)[i0]
+    # Roll each window forward by the overlap.
+    clip = numpy.empty_like(windows)
+    clip[:,overlap:] = windows[:,:width-overlap]
+    clip[:,:overlap] = windows[:,width-overlap:]
+    clip[:,:overlap*2] *= numpy.cos(
         numpy.linspace(0, 2*numpy.pi, overlap * 2)) * 0.5 + 0.5
-    tail = clip[:overlap]
-    body = clip[overlap:]
-    body[:overlap] += tail
-    return numpy.roll(body, -overlap//2)
+    tail = clip[:,:overlap]
+    body = clip[:,overlap:]
+    body[:,:overlap] += tail
+    return numpy.roll(body, -overlap//2, axis=1)
 
-def extract_pitched(name: str, data: numpy.ndarray,
-                    pos: int, length: int) -> numpy.ndarray:
-    mpos = pos + length//2
-    period = get_period(data, mpos)
+def pitch_count(length: int, period: int) -> int:
+    """Return the number of periods to fit in a pitched segment.
+
+    This is whichever of the two nearest whole numbers of periods changes the
+    pitch less, in log frequency.
+    """
     n0 = length // period
     n1 = n0 + 1
     if n0 == 0 or n0 * n1 * period**2 < length**2:
-        n = n1
-    else:
-        n = n0
-    print("Changing pitch of {:3s} {:3.0f} Hz -> {:3.0f} Hz"
-          .format(name, 48000 / period, 48000 * n / length),
-          file=sys.stderr)
-    loop = extract_looped(data, mpos - period*n//2, period*n, period)
-    y = scipy.fftpack.rfft(loop)
-    if len(loop) != length:
-        if len(y) < length:
-            y = numpy.concatenate([y, numpy.zeros(length - len(y))])
-        elif len(y) > length:
-            y = y[:length]
-        loop = scipy.fftpack.irfft(y).astype(numpy.float32)
-    #print(name, ', '.join(
-    #    '{:.1f}'.format(y[i*2]**2 + y[i*2+1]**2) for i in range(n+1)))
-    dphase = 0.5 * math.pi - math.atan2(y[2*n], y[2*n+1])
-    dsamp = round(dphase * length / (2 * math.pi * n))
-    return numpy.roll(loop, dsamp)
+        return n1
+    return n0
+
+def resample_loops(loops: numpy.ndarray, length: int
+                   ) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """Resample loops to a new length and align their phase.
+
+    Each row is resampled by truncating or zero-padding its spectrum, and then
+    rotated so the phase of its fundamental is the same in every segment.
+
+    Arguments:
+      loops: Loops to resample, one in each row, in float32 format.
+      length: New length of each loop, in samples.
+    Returns:
+      A tuple (loops, spectrum), with the resampled loops and their spectrum.
+    """
+    count, size = loops.shape
+    spectrum = numpy.fft.rfft(loops, axis=1)
+    if size != length:
+        nbins = length//2 + 1
+        resized = numpy.zeros((count, nbins), spectrum.dtype)
+        n = min(nbins, spectrum.shape[1])
+        resized[:,:n] = spectrum[:,:n]
+        if size < length and size % 2 == 0:
+            # The Nyquist bin of the shorter spectrum is real.
+            resized[:,size//2] = resized[:,size//2].real
+        spectrum = resized
+        loops = numpy.fft.irfft(spectrum, length, axis=1).astype(
+            numpy.float32, copy=False)
+    return loops, spectrum
+
+def extract_pitched_many(name: str, data: numpy.ndarray,
+                         segments: Sequence[Tuple[int, int]],
+                         periods: Union[Sequence[int], numpy.ndarray]
+                         ) -> List[numpy.ndarray]:
+    """Extract pitched segments, changing their pitch to fit a whole number of
+    periods in each segment.
+
+    Segments with the same period and length are processed together, and
+    the batches are processed concurrently. NumPy releases the GIL for most
+    of the work.
+
+    Arguments:
+      name: Name of the sound, for messages.
+      data: The audio data, in float32 format.
+      segments: List of (pos, length) for each segment.
+      periods: Period of the audio in each segment, in samples.
+    Returns:
+      The audio for each segment.
+    """
+    batches: Dict[Tuple[int, int, int], List[int]] = {}
+    for i, ((pos, length), period) in enumerate(zip(segments, periods)):
+        period = int(period)
+        n = pitch_count(length, period)
+        print("Changing pitch of {:3s} {:3.0f} Hz -> {:3.0f} Hz"
+              .format(name, 48000 / period, 48000 * n / length),
+              file=sys.stderr)
+        batches.setdefault((period, n, length), []).append(i)
+    result: List[numpy.ndarray] = [numpy.zeros(0, numpy.float32)
+                                   for _ in segments]
+
+    def process(key: Tuple[int, int, int], indexes: List[int]) -> None:
+        period, n, length = key
+        mpos = numpy.array([segments[i][0] + length//2 for i in indexes])
+        loops = extract_looped_many(
+            data, mpos - period*n//2, period*n, period)
+        loops, spectrum = resample_loops(loops, length)
+        # This is the phase difference between the imaginary part of the
+        # fundamental and the real part of the next bin, in the packed layout
+        # that scipy.fftpack.rfft uses.
+        dphase = 0.5 * math.pi - numpy.arctan2(
+            spectrum[:,n].imag, spectrum[:,n+1].real)
+        dsamp = numpy.round(dphase * length / (2 * math.pi * n)).astype(int)
+        for i, row, shift in zip(indexes, loops, dsamp.tolist()):
+            result[i] = numpy.roll(row, shift)
+
+    items = list(batches.items())
+    ncpu = os.cpu_count() or 1
+    if ncpu == 1 or len(items) <= 1:
+        for key, indexes in items:
+            process(key, indexes)
+        return result
+    # Batches are grouped into one task for each thread, since most batches
+    # are too small to be worth a task of their own.
+    def process_all(task: List[Tuple[Tuple[int, int, int], List[int]]]
+                    ) -> None:
+        for key, indexes in task:
+            process(key, indexes)
+
+    tasks = [items[i::ncpu] for i in range(min(ncpu, len(items)))]
+    with concurrent.futures.ThreadPoolExecutor(len(tasks)) as executor:
+        for _ in executor.map(process_all, tasks):
+            pass
+    return result
+
+def extract_pitched(name: str, data: numpy.ndarray,
+                    pos: int, length: int,
+                    period: Optional[int] = None) -> numpy.ndarray:
+    """Extract a pitched segment, changing its pitch to fit a whole number of
+    periods in the segment.
+
+    Arguments:
+      period: Period of the audio, in samples. If None, this is detected.
+    """
+    if period is None:
+        period = get_period(data, pos + length//2)
+    return extract_pitched_many(name, data, [(pos, length)], [period])[0]
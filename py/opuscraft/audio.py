@@ -1,122 +1,584 @@
+import concurrent.futures
+import hashlib
+import io
 import os
 import subprocess
 import tempfile
 
 import numpy
 
-from abc import ABCMeta, abstractmethod
-from typing import IO, List, Optional, Set
+from . import cache
+from . import estimate
+from . import opus
+from . import timing
 
-def load_audio(path: str) -> numpy.ndarray:
-    with open(path, "rb") as fp:
-        out = subprocess.run(
-            [
-                "sox",
-                "-",
-                "--channels", "1",
-                "--bits", "32",
-                "--encoding", "floating-point",
-                "--endian", "little",
-                "--type", "raw",
-                "-",
-                "rate", "48000",
-            ],
+from typing import Dict, List, Sequence, Set, Tuple
+
+SOX_ARGS: List[str] = [
+    "--channels", "1",
+    "--bits", "32",
+    "--encoding", "floating-point",
+    "--endian", "little",
+    "--type", "raw",
+]
+
+SOX_EFFECTS: List[str] = ["rate", "48000"]
+
+def decode_audio(path: str, out_path: str) -> None:
+    """Decode an audio file to a raw 48 kHz float32 file with sox."""
+    with timing.span("sox", "subprocess", path=path) as info, \
+         open(path, "rb") as fp:
+        subprocess.run(
+            ["sox", "-"] + SOX_ARGS + [out_path] + SOX_EFFECTS,
             stdin=fp,
-            stdout=subprocess.PIPE,
             check=True,
         )
-    return numpy.frombuffer(out.stdout, dtype=numpy.float32)
+        info["bytes"] = os.path.getsize(out_path)
+
+def map_audio(path: str) -> numpy.ndarray:
+    """Map a raw float32 audio file into memory, read-only."""
+    if os.path.getsize(path) == 0:
+        return numpy.zeros(0, numpy.float32)
+    return numpy.memmap(path, dtype=numpy.float32, mode="r")
+
+# Number of times to try loading an input before giving up, if its cache
+# entry keeps being evicted by other threads.
+LOAD_ATTEMPTS = 3
+
+def load_audio(path: str) -> numpy.ndarray:
+    """Load an audio file as a 48 kHz float32 array.
+
+    The audio is decoded to a raw file and returned as a memory map, so only
+    the parts of the file which are actually used are read into memory.
+
+    Decoded audio is stored in the cache, keyed by the hash of the file and the
+    sox parameters, so loading an unchanged file again returns a memory map of
+    the cached data without running sox. If the cache is disabled, the audio is
+    decoded to a temporary file instead.
+    """
+    acache = cache.audio_cache()
+    if acache is None:
+        fd, tpath = tempfile.mkstemp(suffix=".f32")
+        os.close(fd)
+        try:
+            decode_audio(path, tpath)
+            return map_audio(tpath)
+        finally:
+            os.remove(tpath)
+    key = hashlib.sha256(
+        " ".join([cache.file_hash(path)] + SOX_ARGS + SOX_EFFECTS)
+        .encode("UTF-8")).hexdigest() + ".f32"
+    attempt = 1
+    while True:
+        cpath = acache.get(key)
+        if cpath is None:
+            tpath = acache.temp_path()
+            try:
+                decode_audio(path, tpath)
+                cpath = acache.put(key, tpath)
+            except BaseException:
+                os.remove(tpath)
+                raise
+        try:
+            data = map_audio(cpath)
+        except FileNotFoundError:
+            # Another thread evicted the entry before it was mapped.
+            if attempt >= LOAD_ATTEMPTS:
+                raise
+            attempt += 1
+            continue
+        # The mapping keeps the data even if the entry is evicted now.
+        acache.evict(cpath)
+        return data
+
+def extract_clip(data: numpy.ndarray, pos: int, length: int) -> numpy.ndarray:
+    """Extract a section of an audio array."""
+    end = pos + length
+    if not (0 <= pos <= end <= len(data)):
+        raise ValueError("Position out of range")
+    return data[pos:end]
 
 LENGTHS: List[int] = [120, 240, 480, 960, 1920, 2880]
 
-PACKET_INDEX = 0
+BANDWIDTHS: List[str] = ["NB", "MB", "WB", "SWB", "FB"]
+
+class PacketTable:
+    """Columnar storage for every packet that has been created.
+
+    Packets are identified by their index in the table, and sounds and streams
+    store packets as int32 arrays of indexes. Each packet refers to a span of
+    samples in one of the source arrays.
+
+    Attributes:
+      count: Number of packets in the table.
+      size: Length of each packet, in samples.
+      source: Index of the source array containing each packet's samples.
+      offset: Offset of each packet's samples in its source array.
+      bitrate: Encoder bitrate for each packet.
+      bandwidth: Encoder bandwidth for each packet, an index into BANDWIDTHS.
+      independent: Whether each packet is encoded without prediction.
+      sources: Source arrays containing 48 kHz float32 samples.
+      source_index: Map from the id of each source array to its index.
+      digests: Map from packet index to the hash of its samples and settings,
+        for packets which have been hashed.
+    """
+    count: int
+    size: numpy.ndarray
+    source: numpy.ndarray
+    offset: numpy.ndarray
+    bitrate: numpy.ndarray
+    bandwidth: numpy.ndarray
+    independent: numpy.ndarray
+    sources: List[numpy.ndarray]
+    source_index: Dict[int, int]
+    digests: Dict[int, bytes]
+
+    COLUMNS = [
+        ("size", numpy.int32),
+        ("source", numpy.int32),
+        ("offset", numpy.int64),
+        ("bitrate", numpy.int32),
+        ("bandwidth", numpy.int8),
+        ("independent", numpy.bool_),
+    ]
 
-class Packet(metaclass=ABCMeta):
-    def __init__(self, size: int) -> None:
-        global PACKET_INDEX
-        if size not in LENGTHS:
+    def __init__(self) -> None:
+        self.count = 0
+        for name, dtype in self.COLUMNS:
+            setattr(self, name, numpy.zeros(0, dtype))
+        self.sources = []
+        self.source_index = {}
+        self.digests = {}
+
+    def reserve(self, n: int) -> None:
+        """Make room for n more packets."""
+        capacity = len(self.size)
+        if self.count + n <= capacity:
+            return
+        capacity = max(64, capacity * 2, self.count + n)
+        for name, dtype in self.COLUMNS:
+            column: numpy.ndarray = numpy.zeros(capacity, dtype)
+            column[:self.count] = getattr(self, name)[:self.count]
+            setattr(self, name, column)
+
+    def add_audio(self, data: numpy.ndarray, sizes: Sequence[int], *,
+                  bitrate: int = 6000,
+                  bandwidth: str = "NB",
+                  independent: bool = True) -> numpy.ndarray:
+        """Add packets for consecutive spans of audio and return their indexes.
+
+        Arguments:
+          data: Audio data, in 48 kHz float32 format.
+          sizes: Length of each packet, in samples.
+          independent: If true, the first packet is encoded independently.
+        """
+        sarr = numpy.asarray(sizes, dtype=numpy.int32).reshape(-1)
+        n = len(sarr)
+        if not n:
+            return numpy.zeros(0, numpy.int32)
+        if not numpy.isin(sarr, LENGTHS).all():
             raise ValueError("invalid packet length")
-        self.index = PACKET_INDEX
-        PACKET_INDEX += 1
-        self.size = size
-
-    @abstractmethod
-    def write(self, dfp: IO[bytes], sfp: IO[str]) -> None: pass
-
-class ZeroPacket(Packet):
-    def write(self, dfp: IO[bytes], sfp: IO[str]) -> None:
-        print("zero", self.size, file=sfp)
-
-class AudioPacket(Packet):
-    def __init__(self, data: numpy.ndarray, *,
-                 bitrate: int = 6000,
-                 bandwidth: str = "NB",
-                 independent: bool = False) -> None:
-        super().__init__(len(data))
-        self.data = data
-        self.bitrate = bitrate
-        self.bandwidth = bandwidth
-        self.independent = independent
-
-    def write(self, dfp: IO[bytes], sfp: IO[str]) -> None:
-        dfp.write(self.data.tobytes())
-        print("audio", self.data.shape[0], file=sfp)
-        print("bitrate", self.bitrate, file=sfp)
-        print("bandwidth", self.bandwidth, file=sfp)
-        if self.independent:
-            print("independent", file=sfp)
-        print("end", file=sfp)
-        return self.data.shape[0]
+        if int(sarr.sum(dtype=numpy.int64)) > len(data):
+            raise ValueError("packets are longer than audio")
+        try:
+            bwcode = BANDWIDTHS.index(bandwidth)
+        except ValueError:
+            raise ValueError("invalid bandwidth {!r}".format(bandwidth))
+        source, offset = self.add_source(data)
+        self.reserve(n)
+        i0 = self.count
+        i1 = i0 + n
+        self.size[i0:i1] = sarr
+        self.source[i0:i1] = source
+        self.offset[i0] = offset
+        numpy.cumsum(sarr[:-1], out=self.offset[i0+1:i1])
+        self.offset[i0+1:i1] += offset
+        self.bitrate[i0:i1] = bitrate
+        self.bandwidth[i0:i1] = bwcode
+        self.independent[i0:i1] = False
+        self.independent[i0] = independent
+        self.count = i1
+        return numpy.arange(i0, i1, dtype=numpy.int32)
+
+    def add_source(self, data: numpy.ndarray) -> Tuple[int, int]:
+        """Find or add the source array for audio data.
+
+        If the data is a view of a one-dimensional float32 array, the packets
+        refer to that array instead, so the same source is reused for every
+        clip taken from one input.
+
+        Returns:
+          A tuple (source, offset) with the index of the source array and the
+          offset of the data in it.
+        """
+        base = data
+        while isinstance(base.base, numpy.ndarray):
+            base = base.base
+        offset = 0
+        if (base is not data and base.ndim == 1 and
+                base.dtype == numpy.float32 and base.flags.c_contiguous and
+                data.dtype == base.dtype and data.ndim == 1 and
+                data.strides == (base.itemsize,)):
+            start = (data.__array_interface__["data"][0] -
+                     base.__array_interface__["data"][0])
+            offset = start // base.itemsize
+        else:
+            base = data
+        source = self.source_index.get(id(base))
+        if source is None:
+            source = len(self.sources)
+            self.sources.append(base)
+            self.source_index[id(base)] = source
+        return source, offset
+
+    def data(self, idx: int) -> numpy.ndarray:
+        """Return the samples in an audio packet."""
+        source = self.sources[self.source[idx]]
+        offset = self.offset[idx]
+        return source[offset:offset+self.size[idx]]
+
+    def script(self, idx: int) -> str:
+        """Return the opustool script commands which create a packet.
+
+        Audio data for the packet is read from the data file in order. The
+        encoder is reset before each independent packet, the same way that
+        encode_packets resets it.
+        """
+        return "{}audio {}\nbitrate {}\nbandwidth {}\n{}end\n".format(
+            "reset\n" if self.independent[idx] else "",
+            self.size[idx],
+            self.bitrate[idx],
+            BANDWIDTHS[self.bandwidth[idx]],
+            "independent\n" if self.independent[idx] else "")
+
+    def encode(self, idx: int, encoder: opus.Encoder) -> bytes:
+        """Encode a packet with libopus."""
+        return encoder.encode(
+            self.data(idx),
+            bitrate=int(self.bitrate[idx]),
+            bandwidth=BANDWIDTHS[self.bandwidth[idx]],
+            independent=bool(self.independent[idx]))
+
+    def digest(self, idx: int) -> bytes:
+        """Return the hash of a packet's samples and settings."""
+        result = self.digests.get(idx)
+        if result is None:
+            h = hashlib.blake2b(digest_size=20)
+            h.update("{} {} {} {}\n".format(
+                self.size[idx], self.bitrate[idx],
+                BANDWIDTHS[self.bandwidth[idx]], bool(self.independent[idx]))
+                     .encode("ASCII"))
+            h.update(numpy.ascontiguousarray(self.data(idx),
+                                             dtype=numpy.float32).data)
+            result = h.digest()
+            self.digests[idx] = result
+        return result
+
+    def intern(self, packets: numpy.ndarray) -> numpy.ndarray:
+        """Replace each packet with the lowest indexed identical packet.
+
+        Packets are identical if they have the same samples and settings.
+        Interned packets are
+        encoded once and emitted as the same bytes, even if they come from
+        different sounds. Only the given packets are considered, so the result
+        does not depend on what other streams have been interned.
+        """
+        plist, inverse = numpy.unique(packets, return_inverse=True)
+        canonical = numpy.empty(len(plist), numpy.int32)
+        bank: Dict[bytes, int] = {}
+        for n, idx in enumerate(plist.tolist()):
+            canonical[n] = bank.setdefault(self.digest(idx), idx)
+        return canonical[inverse.reshape(-1)]
+
+    def compact(self, live: numpy.ndarray) -> numpy.ndarray:
+        """Remove every packet which is not in live.
+
+        Sources which no longer contain any packets are released.
+
+        Returns:
+          An array mapping old packet indexes to new ones, with -1 for packets
+          which were removed.
+        """
+        keep = numpy.zeros(self.count, numpy.bool_)
+        keep[live] = True
+        kept = numpy.flatnonzero(keep)
+        mapping = numpy.full(self.count, -1, numpy.int32)
+        mapping[kept] = numpy.arange(len(kept), dtype=numpy.int32)
+        for name, dtype in self.COLUMNS:
+            setattr(self, name, getattr(self, name)[kept])
+        self.count = len(kept)
+        used = numpy.unique(self.source[:self.count])
+        smap = numpy.full(len(self.sources), -1, numpy.int32)
+        smap[used] = numpy.arange(len(used), dtype=numpy.int32)
+        self.source = smap[self.source]
+        self.sources = [self.sources[i] for i in used.tolist()]
+        self.source_index = {id(source): i
+                             for i, source in enumerate(self.sources)}
+        self.digests = {int(mapping[idx]): digest
+                        for idx, digest in self.digests.items()
+                        if mapping[idx] >= 0}
+        return mapping
+
+    def key(self, idx: int, prev: bytes) -> bytes:
+        """Return the cache key for an encoded audio packet.
+
+        Arguments:
+          prev: Key of the previous packet given to the encoder, which
+            identifies the encoder state.
+        """
+        return hashlib.blake2b(prev + self.digest(idx),
+                               digest_size=20).digest()
+
+# All packets.
+PACKETS = PacketTable()
+
+# Encoded packets from this process, by cache key.
+ENCODED: Dict[bytes, bytes] = {}
+
+# Keys of the packets in ENCODED which were used since the last collect().
+ENCODED_USED: Set[bytes] = set()
+
+def collect(live: Sequence[numpy.ndarray]) -> numpy.ndarray:
+    """Free the packets which are not in any of the given arrays.
+
+    Encoded packets which were not used since the last collection are also
+    removed from ENCODED.
+
+    Returns:
+      An array mapping old packet indexes to new ones, which the caller must
+      apply to every packet index it keeps.
+    """
+    mapping = PACKETS.compact(
+        numpy.concatenate([numpy.zeros(0, numpy.int32)] + list(live)))
+    for key in [key for key in ENCODED if key not in ENCODED_USED]:
+        del ENCODED[key]
+    ENCODED_USED.clear()
+    return mapping
+
+def encode_runs(packets: numpy.ndarray,
+                runs: List[Tuple[int, int]]) -> List[List[bytes]]:
+    """Encode runs of packets, resetting the encoder before each run."""
+    encoder = opus.Encoder()
+    result: List[List[bytes]] = []
+    for start, end in runs:
+        encoder.reset()
+        result.append([PACKETS.encode(idx, encoder)
+                       for idx in packets[start:end]])
+    return result
+
+def encode_packets(packets: numpy.ndarray) -> List[bytes]:
+    """Encode a list of packets with libopus, in order.
+
+    The encoder is reset at each independent packet, so each run of packets
+    starting with an independent packet is encoded the same way no matter what
+    comes before it. Encoded packets are stored in the packet cache, keyed by
+    the packet's samples and settings and the packets before it in its run. A
+    run is only encoded again if any of its packets are missing from the cache.
+    Packets are also kept in memory, so encoding the same packets again in the
+    same process does not touch the disk.
+
+    Runs are independent of each other, so they are encoded concurrently, each
+    thread with its own encoder. The encoder releases the GIL.
+    """
+    with timing.span("encode_packets", "encode",
+                     packets=len(packets)) as info:
+        keys: List[bytes] = []
+        starts: List[int] = []
+        base = opus.version().encode("UTF-8")
+        prev = base
+        for n, idx in enumerate(packets):
+            if PACKETS.independent[idx]:
+                starts.append(n)
+                prev = base
+            prev = PACKETS.key(idx, prev)
+            keys.append(prev)
+        ENCODED_USED.update(keys)
+        if not starts or starts[0] != 0:
+            starts.insert(0, 0)
+
+        encoded: Dict[int, bytes] = {}
+        for n, key in enumerate(keys):
+            if key in ENCODED:
+                encoded[n] = ENCODED[key]
+        if len(encoded) == len(keys):
+            pcache = None
+        else:
+            pcache = cache.packet_cache()
+        new: List[Tuple[bytes, bytes]] = []
+        try:
+            if pcache is not None:
+                cached = pcache.get_many(
+                    key for n, key in enumerate(keys) if n not in encoded)
+                for n, key in enumerate(keys):
+                    if key in cached:
+                        encoded[n] = cached[key]
+                        ENCODED[key] = cached[key]
+            runs = [(start, end) for start, end
+                    in zip(starts, starts[1:] + [len(packets)])
+                    if not all(n in encoded for n in range(start, end))]
+            # Runs are grouped into batches so each task can reuse one
+            # encoder.
+            nbatch = min(len(runs), (os.cpu_count() or 1) * 4)
+            batches = [runs[i::nbatch] for i in range(nbatch)]
+            with concurrent.futures.ThreadPoolExecutor() as executor:
+                for batch, results in zip(batches, executor.map(
+                        lambda batch: encode_runs(packets, batch), batches)):
+                    for (start, end), run in zip(batch, results):
+                        for n, data in enumerate(run, start):
+                            encoded[n] = data
+                            new.append((keys[n], data))
+                            ENCODED[keys[n]] = data
+            info["encoded"] = len(new)
+            if pcache is not None and new:
+                pcache.put_many(new)
+        finally:
+            if pcache is not None:
+                pcache.close()
+    return [encoded[n] for n in range(len(packets))]
+
+def opustool_path() -> str:
+    """Return the path to the opustool executable."""
+    return os.path.join(
+        os.path.dirname(
+            os.path.dirname(
+                os.path.dirname(
+                    os.path.abspath(__file__)))),
+        "opustool/opustool")
+
+def encoder_id() -> str:
+    """Return a string which identifies the encoder that Stream.encode uses.
+
+    Different encoders, or different versions of libopus, may encode the same
+    packets differently.
+    """
+    if opus.available():
+        return opus.version()
+    try:
+        return "opustool " + cache.file_hash(opustool_path())
+    except OSError:
+        return "opustool"
 
 class Stream:
     """A stream of Opus packets to emit.
 
     Attributes:
       length: Length of the emitted packets, in samples.
-      program: List of packets to emit.
+      packets: Indexes in PACKETS of the packets to emit, an int32 array.
+      buffer: Storage for the packet indexes, with room to grow.
+      count: Number of packets in the stream.
     """
     length: int
-    packets: List[Packet]
+    buffer: numpy.ndarray
+    count: int
 
     def __init__(self) -> None:
         self.length = 0
-        self.packets = []
+        self.buffer = numpy.zeros(64, numpy.int32)
+        self.count = 0
+
+    @property
+    def packets(self) -> numpy.ndarray:
+        return self.buffer[:self.count]
+
+    def reserve(self, n: int) -> None:
+        """Make room for n more packets."""
+        if self.count + n <= len(self.buffer):
+            return
+        buffer = numpy.zeros(max(len(self.buffer) * 2, self.count + n),
+                             numpy.int32)
+        buffer[:self.count] = self.buffer[:self.count]
+        self.buffer = buffer
 
-    def append(self, packet: Packet) -> None:
-        self.length += packet.size
-        self.packets.append(packet)
+    def append(self, packet: int) -> None:
+        self.reserve(1)
+        self.buffer[self.count] = packet
+        self.count += 1
+        self.length += int(PACKETS.size[packet])
 
-    def extend(self, packets: List[Packet]) -> None:
-        self.length += sum(packet.size for packet in packets)
-        self.packets.extend(packets)
+    def extend(self, packets: numpy.ndarray) -> None:
+        n = len(packets)
+        self.reserve(n)
+        self.buffer[self.count:self.count+n] = packets
+        self.count += n
+        self.length += int(PACKETS.size[packets].sum(dtype=numpy.int64))
+
+    def program(self) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """Return the unique packets and the order to emit them in.
+
+        Packets are interned first, so identical packets from different sounds
+        are only encoded once. The unique packets are sorted by index, and the
+        order contains indexes into the array of unique packets.
+        """
+        plist, order = numpy.unique(PACKETS.intern(self.packets),
+                                    return_inverse=True)
+        return plist, order.reshape(-1)
 
     def encode(self, path: str) -> None:
-        pset: Set[int] = set()
-        plist: List[Packet] = []
-        for packet in self.packets:
-            idx = packet.index
-            if idx in pset:
-                continue
-            pset.add(idx)
-            plist.append(packet)
-        plist.sort(key=lambda packet: packet.index)
-        pmap = {packet.index: n for n, packet in enumerate(plist)}
-
-        exe = os.path.join(
-            os.path.dirname(
-                os.path.dirname(
-                    os.path.dirname(
-                        os.path.abspath(__file__)))),
-            "opustool/opustool")
+        """Encode the stream as an Ogg Opus file.
+
+        This uses libopus directly if it is available, and falls back to
+        running opustool otherwise.
+        """
+        if not opus.available():
+            plist, order = self.program()
+            self.encode_opustool(plist, order, path)
+            return
+        data = self.encode_bytes()
+        with timing.span("write", "write", path=path, bytes=len(data)):
+            with open(path, "wb") as fp:
+                fp.write(data)
+
+    def estimate_size(self) -> int:
+        """Estimate the size of the encoded stream after Deflate compression.
+
+        This uses a model of Deflate's matching instead of compressing the
+        stream. Packets are encoded with libopus, but encoded packets are
+        cached, so this is fast when the same packets are rearranged.
+        """
+        plist, order = self.program()
+        return estimate.estimate_deflate(encode_packets(plist), order.tolist())
+
+    def match_stats(self) -> estimate.MatchStats:
+        """Measure how far repeated packets are from their previous copies.
+
+        This encodes the packets with libopus, but encoded packets are cached,
+        so this is fast after the stream has been encoded.
+        """
+        plist, order = self.program()
+        return estimate.match_stats(encode_packets(plist), order.tolist())
+
+    def encode_bytes(self) -> bytes:
+        """Encode the stream as an Ogg Opus file in memory, using libopus."""
+        plist, order = self.program()
+        data = encode_packets(plist)
+        with timing.span("write_opus", "mux", packets=len(order)) as info:
+            fp = io.BytesIO()
+            opus.write_opus(fp, data, PACKETS.size[plist].tolist(),
+                            order.tolist())
+            info["bytes"] = fp.tell()
+        return fp.getvalue()
+
+    def encode_opustool(self, plist: numpy.ndarray, order: numpy.ndarray,
+                        path: str) -> None:
+        exe = opustool_path()
+
+        nbytes = int(PACKETS.size[plist].sum(dtype=numpy.int64)) * 4
+        script = "".join(
+            [PACKETS.script(idx) for idx in plist] +
+            ["emit {}\n".format(idx) for idx in order.tolist()])
 
         with tempfile.TemporaryDirectory("opuscraft") as d:
             dpath = os.path.join(d, "data")
             spath = os.path.join(d, "script")
+            # Each packet's samples are written straight from its source,
+            # without copying them into one buffer first.
+            with open(dpath, "wb") as dfp:
+                for idx in plist.tolist():
+                    dfp.write(numpy.ascontiguousarray(
+                        PACKETS.data(idx), dtype=numpy.float32).data)
             with open(spath, "w") as sfp:
-                with open(dpath, "wb") as dfp:
-                    for packet in plist:
-                        packet.write(dfp, sfp)
-                for packet in self.packets:
-                    print("emit", pmap[packet.index], file=sfp)
+                sfp.write(script)
 
-            subprocess.run([exe, dpath, spath, path], check=True)
+            with timing.span("opustool", "subprocess",
+                             packets=len(plist), bytes=nbytes):
+                subprocess.run([exe, dpath, spath, path], check=True)
@@ -0,0 +1,372 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy
+
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+# Version of the baseline file format.
+BASELINE_VERSION = 1
+
+# Sample rate of all signals, in Hz.
+RATE = 48000
+
+def tone(length: int, seed: int = 0) -> numpy.ndarray:
+    """Return a pitched tone with vibrato and harmonics, like a sung vowel.
+
+    The fundamental is between 80 and 133 Hz, so its period is in the range
+    that get_period detects.
+    """
+    rng = numpy.random.RandomState(seed)
+    t = numpy.arange(length) / RATE
+    f0 = 100 + 5 * numpy.sin(2 * numpy.pi * 5 * t) + rng.uniform(-5, 5)
+    phase = 2 * numpy.pi * numpy.cumsum(f0) / RATE
+    data = numpy.zeros(length)
+    for k in range(1, 11):
+        data += numpy.sin(k * phase) / k
+    return (data * 0.2).astype(numpy.float32)
+
+def noise(length: int, seed: int = 0) -> numpy.ndarray:
+    """Return white noise."""
+    rng = numpy.random.RandomState(seed)
+    return (rng.standard_normal(length) * 0.1).astype(numpy.float32)
+
+def sweep(length: int, seed: int = 0) -> numpy.ndarray:
+    """Return a speech-like signal with gliding pitch and syllable envelope.
+
+    The pitch glides between 85 and 125 Hz over each second, and the level
+    rises and falls about four times a second, with a little noise.
+    """
+    t = numpy.arange(length) / RATE
+    f0 = 105 + 20 * numpy.sin(2 * numpy.pi * t)
+    phase = 2 * numpy.pi * numpy.cumsum(f0) / RATE
+    data = numpy.zeros(length)
+    for k in range(1, 16):
+        # Emphasize harmonics near two moving formants.
+        f = k * f0
+        gain = (numpy.exp(-((f - 700 - 200 * numpy.sin(3 * t)) / 300)**2) +
+                0.5 * numpy.exp(-((f - 1500) / 400)**2) + 0.05)
+        data += gain * numpy.sin(k * phase)
+    envelope = 0.55 + 0.45 * numpy.sin(2 * numpy.pi * 4 * t)
+    data = data * envelope * 0.1 + noise(length, seed) * 0.05
+    return data.astype(numpy.float32)
+
+SIGNALS: Dict[str, Callable[[int], numpy.ndarray]] = {
+    "tone": tone,
+    "noise": noise,
+    "sweep": sweep,
+}
+
+class Skip(Exception):
+    """A benchmark cannot run in this environment."""
+
+class Benchmark(NamedTuple):
+    """A benchmark of one operation.
+
+    Attributes:
+      name: Unique name, used to match results with baselines.
+      setup: Function which prepares the input and returns the function to
+        time, and the amount of work it does.
+      unit: Unit of work, used to report throughput.
+    """
+    name: str
+    setup: Callable[[], Tuple[Callable[[], Any], int]]
+    unit: str
+
+def bench_get_period(signal: str, count: int) -> Benchmark:
+    from . import analyze
+
+    def setup() -> Tuple[Callable[[], Any], int]:
+        margin = analyze.PERIOD_MAX * 3 + 1
+        data = SIGNALS[signal](margin * 2 + count * 480)
+        positions = [margin + i * 480 for i in range(count)]
+        def run() -> None:
+            for pos in positions:
+                analyze.get_period(data, pos)
+        return run, count
+
+    return Benchmark("get_period/{}/{}".format(signal, count), setup,
+                     "positions")
+
+def bench_get_periods(signal: str, count: int) -> Benchmark:
+    from . import analyze
+
+    def setup() -> Tuple[Callable[[], Any], int]:
+        margin = analyze.PERIOD_MAX * 3 + 1
+        data = SIGNALS[signal](margin * 2 + count * 480)
+        positions = [margin + i * 480 for i in range(count)]
+        return lambda: analyze.get_periods(data, positions), count
+
+    return Benchmark("get_periods/{}/{}".format(signal, count), setup,
+                     "positions")
+
+def bench_extract_looped(length: int) -> Benchmark:
+    from . import analyze
+
+    def setup() -> Tuple[Callable[[], Any], int]:
+        data = tone(length * 3)
+        return (lambda: analyze.extract_looped(data, length, length, 480),
+                length)
+
+    return Benchmark("extract_looped/{}".format(length), setup, "samples")
+
+def bench_extract_pitched(signal: str, length: int) -> Benchmark:
+    from . import analyze
+
+    def setup() -> Tuple[Callable[[], Any], int]:
+        data = SIGNALS[signal](length * 3 + RATE)
+        pos = length + RATE // 2
+        period = analyze.get_period(data, pos + length // 2)
+        return (lambda: analyze.extract_pitched(
+            signal, data, pos, length, period), length)
+
+    return Benchmark("extract_pitched/{}/{}".format(signal, length), setup,
+                     "samples")
+
+def bench_extract_pitched_many(signal: str, count: int) -> Benchmark:
+    from . import analyze
+
+    def setup() -> Tuple[Callable[[], Any], int]:
+        length = 2880
+        data = SIGNALS[signal](length * (count + 2) + RATE)
+        segments = [(RATE // 2 + i * length, length) for i in range(count)]
+        periods = analyze.get_periods(
+            data, [pos + length // 2 for pos, length in segments])
+        return (lambda: analyze.extract_pitched_many(
+            signal, data, segments, periods), length * count)
+
+    return Benchmark("extract_pitched_many/{}/{}".format(signal, count),
+                     setup, "samples")
+
+def bench_packetize(count: int) -> Benchmark:
+    from . import script
+
+    def setup() -> Tuple[Callable[[], Any], int]:
+        lengths = [(i * 4801) % (RATE * 2) for i in range(count)]
+        def run() -> None:
+            for length in lengths:
+                for _ in script.packetize(length):
+                    pass
+        return run, count
+
+    return Benchmark("packetize/{}".format(count), setup, "lengths")
+
+def bench_stretch_pitch(ngroups: int, seconds: int) -> Benchmark:
+    from . import audio
+    from . import script
+    from .sound import StretchPitchSound
+
+    def setup() -> Tuple[Callable[[], Any], int]:
+        data = tone(ngroups * RATE // 10)
+        sizes = list(script.packetize(RATE // 10))
+        groups = [
+            audio.PACKETS.add_audio(data[i*RATE//10:(i+1)*RATE//10], sizes)
+            for i in range(ngroups)]
+        sound = StretchPitchSound(groups)
+        length = seconds * RATE
+        def run() -> None:
+            sound.emit(audio.Stream(), length)
+        return run, length
+
+    return Benchmark("stretch_pitch/{}/{}s".format(ngroups, seconds), setup,
+                     "samples")
+
+def bench_encode(signal: str, seconds: int) -> Benchmark:
+    from . import audio
+    from . import opus
+
+    def setup() -> Tuple[Callable[[], Any], int]:
+        if not opus.available():
+            raise Skip("libopus is not available")
+        length = seconds * RATE
+        data = SIGNALS[signal](length)
+        packets = audio.PACKETS.add_audio(data, [960] * (length // 960))
+        stream = audio.Stream()
+        # Repeat each packet, the way scripts do.
+        stream.extend(numpy.repeat(packets, 2))
+        def run() -> None:
+            audio.ENCODED.clear()
+            stream.encode(os.devnull)
+        return run, length
+
+    return Benchmark("encode/{}/{}s".format(signal, seconds), setup,
+                     "samples")
+
+def all_benchmarks() -> List[Benchmark]:
+    benchmarks = []
+    for signal in SIGNALS:
+        for count in [10, 100]:
+            benchmarks.append(bench_get_period(signal, count))
+        for count in [10, 100, 1000]:
+            benchmarks.append(bench_get_periods(signal, count))
+    for length in [4800, 48000, 480000]:
+        benchmarks.append(bench_extract_looped(length))
+    for signal in SIGNALS:
+        for length in [960, 9600, 96000]:
+            benchmarks.append(bench_extract_pitched(signal, length))
+    for signal in SIGNALS:
+        for count in [10, 500]:
+            benchmarks.append(bench_extract_pitched_many(signal, count))
+    for count in [1000, 100000]:
+        benchmarks.append(bench_packetize(count))
+    for ngroups in [4, 32]:
+        for seconds in [1, 60]:
+            benchmarks.append(bench_stretch_pitch(ngroups, seconds))
+    for signal in SIGNALS:
+        for seconds in [1, 10]:
+            benchmarks.append(bench_encode(signal, seconds))
+    return benchmarks
+
+def measure(benchmark: Benchmark, *,
+            min_time: float, repeat: int) -> Dict[str, Any]:
+    """Run a benchmark and return its results.
+
+    The function is run at least repeat times, and until min_time has passed,
+    and the fastest run is reported. Peak memory is measured with tracemalloc
+    in a separate run, since tracing slows down allocation.
+    """
+    func, work = benchmark.setup()
+    func()
+    times: List[float] = []
+    start = time.perf_counter()
+    while len(times) < repeat or time.perf_counter() - start < min_time:
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    best = min(times)
+    return {
+        "time": best,
+        "median": float(numpy.median(times)),
+        "runs": len(times),
+        "throughput": work / best if best > 0 else float("inf"),
+        "unit": benchmark.unit,
+        "peak": peak,
+    }
+
+def format_rate(rate: float) -> str:
+    for scale, suffix in [(1e9, "G"), (1e6, "M"), (1e3, "k")]:
+        if rate >= scale:
+            return "{:.2f}{}".format(rate / scale, suffix)
+    return "{:.2f}".format(rate)
+
+def run(benchmarks: List[Benchmark], *,
+        min_time: float, repeat: int,
+        baseline: Optional[Dict[str, Any]] = None,
+        threshold: float = 1.1) -> Tuple[Dict[str, Any], List[str]]:
+    """Run benchmarks and print their results.
+
+    Arguments:
+      baseline: Results from a previous run to compare against.
+      threshold: Ratio of time to baseline time above which a benchmark has
+        regressed.
+    Returns:
+      A tuple (results, regressions), with the results of each benchmark by
+      name and the names of benchmarks which regressed.
+    """
+    results: Dict[str, Any] = {}
+    regressions: List[str] = []
+    print("    {:32}  {:>10}  {:>20}  {:>10}  {:>8}".format(
+        "Benchmark", "Time (ms)", "Throughput (/s)", "Peak (KiB)",
+        "Change"))
+    for benchmark in benchmarks:
+        try:
+            # Silence the progress messages of the functions under test.
+            with contextlib.redirect_stderr(io.StringIO()):
+                result = measure(benchmark, min_time=min_time, repeat=repeat)
+        except Skip as ex:
+            print("    {:32}  skipped: {}".format(benchmark.name, ex))
+            continue
+        results[benchmark.name] = result
+        change = ""
+        if baseline is not None:
+            base = baseline.get(benchmark.name)
+            if base is not None and base["time"] > 0:
+                ratio = result["time"] / base["time"]
+                change = "{:+.1f}%".format((ratio - 1) * 100)
+                if ratio > threshold:
+                    change += " !"
+                    regressions.append(benchmark.name)
+        print("    {:32}  {:10.3f}  {:>20}  {:10.1f}  {:>8}".format(
+            benchmark.name, result["time"] * 1e3,
+            "{} {}".format(format_rate(result["throughput"]),
+                           result["unit"]),
+            result["peak"] / 1024, change))
+        sys.stdout.flush()
+    return results, regressions
+
+def load_baseline(path: str) -> Dict[str, Any]:
+    with open(path) as fp:
+        obj = json.load(fp)
+    if obj.get("version") != BASELINE_VERSION:
+        raise ValueError("unsupported baseline version")
+    return obj["results"]
+
+def save_baseline(path: str, results: Dict[str, Any]) -> None:
+    obj = {
+        "version": BASELINE_VERSION,
+        "numpy": numpy.__version__,
+        "python": sys.version.split()[0],
+        "results": results,
+    }
+    with open(path, "w") as fp:
+        json.dump(obj, fp, indent=True, sort_keys=True)
+
+def main() -> None:
+    p = argparse.ArgumentParser(
+        description="Benchmark the audio processing functions.")
+    p.add_argument("filter", nargs="*",
+                   help="only run benchmarks whose names contain one of these")
+    p.add_argument("--save", metavar="FILE",
+                   help="save results as a baseline")
+    p.add_argument("--compare", metavar="FILE",
+                   help="compare results with a saved baseline")
+    p.add_argument("--threshold", type=float, default=10,
+                   help="slowdown which counts as a regression, in percent")
+    p.add_argument("--min-time", type=float, default=0.2,
+                   help="minimum time to run each benchmark, in seconds")
+    p.add_argument("--repeat", type=int, default=3,
+                   help="minimum number of runs of each benchmark")
+    p.add_argument("--list", action="store_true",
+                   help="list benchmarks without running them")
+    args = p.parse_args()
+
+    # Measure encoding, not the packet cache.
+    os.environ["OPUSCRAFT_CACHE"] = ""
+    benchmarks = [b for b in all_benchmarks()
+                  if not args.filter or any(f in b.name for f in args.filter)]
+    if args.list:
+        for benchmark in benchmarks:
+            print(benchmark.name)
+        return
+    baseline = None
+    if args.compare:
+        try:
+            baseline = load_baseline(args.compare)
+        except (OSError, ValueError) as ex:
+            print("Error: could not load baseline: {}".format(ex),
+                  file=sys.stderr)
+            raise SystemExit(1)
+    results, regressions = run(
+        benchmarks, min_time=args.min_time, repeat=args.repeat,
+        baseline=baseline, threshold=1 + args.threshold / 100)
+    if args.save:
+        save_baseline(args.save, results)
+    if regressions:
+        print("Regressions: {}".format(", ".join(regressions)),
+              file=sys.stderr)
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
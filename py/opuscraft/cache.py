@@ -0,0 +1,245 @@
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# Default size limit for each cache, in MiB.
+DEFAULT_LIMIT = 4096
+
+# Version of the packet cache format and of the way packet keys are computed.
+# Changing this clears the packet cache.
+PACKET_VERSION = 2
+
+def cache_dir() -> Optional[str]:
+    """Return the path to the cache directory, or None if caching is disabled.
+
+    The directory is taken from $OPUSCRAFT_CACHE, and caching is disabled if
+    that variable is set to the empty string.
+    """
+    path = os.environ.get("OPUSCRAFT_CACHE")
+    if path is None:
+        base = (os.environ.get("XDG_CACHE_HOME") or
+                os.path.join(os.path.expanduser("~"), ".cache"))
+        return os.path.join(base, "opuscraft")
+    return path or None
+
+# Map from (path, size, modification time) to file hash.
+FILE_HASHES: Dict[Tuple[str, int, int], str] = {}
+
+def file_hash(path: str) -> str:
+    """Return the SHA-256 hash of a file's contents, as a hex string.
+
+    Hashes are remembered for as long as the file's size and modification time
+    are unchanged.
+    """
+    st = os.stat(path)
+    mkey = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    result = FILE_HASHES.get(mkey)
+    if result is not None:
+        return result
+    h = hashlib.sha256()
+    with open(path, "rb") as fp:
+        while True:
+            block = fp.read(1 << 20)
+            if not block:
+                break
+            h.update(block)
+    result = h.hexdigest()
+    FILE_HASHES[mkey] = result
+    return result
+
+# Lock held while file caches are read or changed. Inputs are loaded on
+# several threads, and without this one thread could evict an entry that
+# another thread has just found.
+FILE_CACHE_LOCK = threading.Lock()
+
+class FileCache:
+    """A directory of cached files with a size limit and LRU eviction.
+
+    Entries are files named by key. The modification time of each entry is
+    updated whenever it is used, and the least recently used entries are
+    removed when the total size goes over the limit. Eviction is a separate
+    step, so callers can open a new entry before anything is evicted. An
+    entry can still be evicted between get() and opening it, so callers
+    should handle FileNotFoundError.
+
+    Attributes:
+      path: Path to the cache directory.
+      limit: Maximum total size of the cache, in bytes.
+    """
+    path: str
+    limit: int
+
+    def __init__(self, path: str, limit: int) -> None:
+        self.path = path
+        self.limit = limit
+        os.makedirs(path, exist_ok=True)
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the path to a cache entry, or None if it does not exist."""
+        path = os.path.join(self.path, key)
+        with FILE_CACHE_LOCK:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                return None
+        return path
+
+    def temp_path(self) -> str:
+        """Create a temporary file which can later be added to the cache."""
+        fd, path = tempfile.mkstemp(suffix=".tmp", dir=self.path)
+        os.close(fd)
+        return path
+
+    def put(self, key: str, temp_path: str) -> str:
+        """Move a temporary file into the cache and return its new path.
+
+        This does not evict anything, call evict() afterwards.
+        """
+        path = os.path.join(self.path, key)
+        with FILE_CACHE_LOCK:
+            os.replace(temp_path, path)
+        return path
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        """Remove least recently used entries until the cache fits its limit."""
+        with FILE_CACHE_LOCK:
+            self.evict_locked(keep)
+
+    def evict_locked(self, keep: Optional[str]) -> None:
+        entries: List[Tuple[float, int, str]] = []
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for mtime, size, path in entries)
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.limit:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+def cache_limit() -> int:
+    """Return the size limit for each cache, in bytes.
+
+    The limit is taken from $OPUSCRAFT_CACHE_SIZE, in MiB.
+    """
+    try:
+        limit = int(os.environ.get("OPUSCRAFT_CACHE_SIZE", DEFAULT_LIMIT))
+    except ValueError:
+        limit = DEFAULT_LIMIT
+    return limit << 20
+
+def audio_cache() -> Optional[FileCache]:
+    """Return the cache for decoded audio, or None if caching is disabled."""
+    path = cache_dir()
+    if path is None:
+        return None
+    return FileCache(os.path.join(path, "audio"), cache_limit())
+
+def plan_cache() -> Optional[FileCache]:
+    """Return the cache for packet layouts, or None if caching is disabled."""
+    path = cache_dir()
+    if path is None:
+        return None
+    return FileCache(os.path.join(path, "plans"), cache_limit())
+
+class PacketCache:
+    """A persistent map from packet keys to encoded Opus packets, with a size
+    limit and LRU eviction.
+
+    The database is cleared if it was written with a different PACKET_VERSION.
+
+    Attributes:
+      limit: Maximum total size of the encoded packets, in bytes.
+    """
+    limit: int
+
+    def __init__(self, path: str, limit: int) -> None:
+        self.limit = limit
+        self.db = sqlite3.connect(path)
+        with self.db:
+            version, = self.db.execute("PRAGMA user_version").fetchone()
+            if version != PACKET_VERSION:
+                self.db.execute("DROP TABLE IF EXISTS packet")
+                self.db.execute(
+                    "PRAGMA user_version = {:d}".format(PACKET_VERSION))
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS packet "
+                "(key BLOB PRIMARY KEY, data BLOB NOT NULL, "
+                "used REAL NOT NULL)")
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS packet_used ON packet (used)")
+
+    def close(self) -> None:
+        self.db.close()
+
+    def get_many(self, keys: Iterable[bytes]) -> Dict[bytes, bytes]:
+        """Return the cached packets for the given keys which are present."""
+        result: Dict[bytes, bytes] = {}
+        keys = list(keys)
+        now = time.time()
+        with self.db:
+            # Stay under SQLite's default limit on host parameters.
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i+500]
+                params = ", ".join("?" for _ in chunk)
+                query = "SELECT key, data FROM packet WHERE key IN ({})"
+                for key, data in self.db.execute(query.format(params), chunk):
+                    result[bytes(key)] = bytes(data)
+                update: List[Any] = [now]
+                update.extend(chunk)
+                self.db.execute(
+                    "UPDATE packet SET used = ? WHERE key IN ({})"
+                    .format(params), update)
+        return result
+
+    def put_many(self, items: Iterable[Tuple[bytes, bytes]]) -> None:
+        """Add encoded packets to the cache."""
+        now = time.time()
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO packet (key, data, used) "
+                "VALUES (?, ?, ?)",
+                ((key, data, now) for key, data in items))
+        self.evict()
+
+    def evict(self) -> None:
+        """Remove least recently used packets until the cache fits its limit."""
+        total, = self.db.execute(
+            "SELECT COALESCE(SUM(LENGTH(data)), 0) FROM packet").fetchone()
+        if total <= self.limit:
+            return
+        keys: List[bytes] = []
+        for key, size in self.db.execute(
+                "SELECT key, LENGTH(data) FROM packet ORDER BY used"):
+            if total <= self.limit:
+                break
+            keys.append(key)
+            total -= size
+        with self.db:
+            self.db.executemany(
+                "DELETE FROM packet WHERE key = ?", ((key,) for key in keys))
+
+def packet_cache() -> Optional[PacketCache]:
+    """Return the cache for encoded packets, or None if caching is disabled."""
+    path = cache_dir()
+    if path is None:
+        return None
+    os.makedirs(path, exist_ok=True)
+    return PacketCache(os.path.join(path, "packets.sqlite"), cache_limit())
@@ -0,0 +1,222 @@
+import math
+
+import numpy
+
+from typing import Dict, List, NamedTuple, Sequence
+
+# Size of the Deflate window, in bytes.
+WINDOW = 32768
+
+# Longest Deflate match, in bytes.
+MAX_MATCH = 258
+
+# Approximate cost of one Deflate match, in bits. This covers the length and
+# distance codes and their extra bits.
+MATCH_BITS = 24
+
+# Approximate cost of one Ogg segment table entry for a new packet, in bits.
+# Entries for repeated packets are part of repeated sequences in the segment
+# table and are nearly free.
+SEGMENT_BITS = 4
+
+# Size of an Ogg page header without the segment table, in bytes.
+PAGE_HEADER = 27
+
+# Ogg page size that the encoder fills pages to, in bytes.
+PAGE_FILL = 1 << 15
+
+# Size of the OpusHead and OpusTags pages after compression, in bytes.
+OPUS_HEADERS = 53
+
+# Approximate cost of the Huffman tables in each Deflate block, in bits.
+BLOCK_BITS = 400
+
+# Approximate number of bits in each Deflate block.
+BLOCK_SIZE = 16384 * 8
+
+def literal_bits(packets: Sequence[bytes]) -> List[float]:
+    """Return the cost of each packet if it is encoded as literals, in bits.
+
+    This uses the order-0 entropy of all the packet data, since Deflate uses
+    one literal code for all of it.
+    """
+    if not packets:
+        return []
+    counts = numpy.zeros(256)
+    for data in packets:
+        counts += numpy.bincount(numpy.frombuffer(data, numpy.uint8),
+                                 minlength=256)
+    total = counts.sum()
+    if not total:
+        return [0.0 for _ in packets]
+    p = counts[counts > 0] / total
+    entropy = max(float(-(p * numpy.log2(p)).sum()), 1.0)
+    return [len(data) * entropy for data in packets]
+
+def estimate_deflate(packets: Sequence[bytes], order: Sequence[int]) -> int:
+    """Estimate the size of an Ogg Opus stream after Deflate compression.
+
+    This models LZ77 matching over the packet data. A packet is a match if
+    an earlier copy of it is still in the Deflate window, and consecutive
+    packets which repeat an earlier sequence extend the same match. Everything
+    else is encoded as literals.
+
+    Arguments:
+      packets: Encoded packets.
+      order: Indexes of the packets to emit, in order.
+    Returns:
+      The estimated size, in bytes.
+    """
+    lbits = literal_bits(packets)
+    last: Dict[int, int] = {}
+    starts: List[int] = []
+    pos = 0
+    bits = 0.0
+    segments = 0
+    src = -1
+    match_len = 0
+    for i, idx in enumerate(order):
+        n = len(packets[idx])
+        if src >= 0 and order[src+1] == idx:
+            src += 1
+            match_len += n
+        else:
+            if match_len:
+                bits += MATCH_BITS * math.ceil(match_len / MAX_MATCH)
+            src = -1
+            match_len = 0
+            j = last.get(idx)
+            if j is not None and n >= 3 and pos - starts[j] <= WINDOW - n:
+                src = j
+                match_len = n
+            else:
+                bits += lbits[idx]
+                segments += n // 255 + 1
+        last[idx] = i
+        starts.append(pos)
+        pos += n
+    if match_len:
+        bits += MATCH_BITS * math.ceil(match_len / MAX_MATCH)
+    bits += segments * SEGMENT_BITS
+    bits += (pos // PAGE_FILL + 1) * PAGE_HEADER * 8
+    bits += (int(bits) // BLOCK_SIZE + 1) * BLOCK_BITS
+    return OPUS_HEADERS + math.ceil(bits / 8)
+
+def stream_bytes(size: int) -> int:
+    """Return the number of bytes a packet adds to an Ogg stream.
+
+    This counts the packet data and its segment table entries, but not page
+    headers.
+    """
+    return size + size // 255 + 1
+
+class MatchStats(NamedTuple):
+    """Statistics about how far apart repeated packets are in a stream.
+
+    Distances are measured with stream_bytes, so they leave out page headers
+    and are slightly short.
+
+    Attributes:
+      repeats: Number of packets which repeat an earlier packet.
+      matched: Number of repeated packets close enough to the previous copy
+        for Deflate to match.
+      missed: Size of the repeated packets too far from the previous copy,
+        in bytes.
+      median: Median distance back to the previous copy, in bytes.
+      max: Largest distance back to the previous copy, in bytes.
+    """
+    repeats: int
+    matched: int
+    missed: int
+    median: int
+    max: int
+
+def match_stats(packets: Sequence[bytes], order: Sequence[int]) -> MatchStats:
+    """Measure how far repeated packets are from their previous copies.
+
+    Arguments:
+      packets: Encoded packets.
+      order: Indexes of the packets to emit, in order.
+    """
+    last: Dict[int, int] = {}
+    distances: List[int] = []
+    matched = 0
+    missed = 0
+    pos = 0
+    for idx in order:
+        n = len(packets[idx])
+        prev = last.get(idx)
+        if prev is not None:
+            distances.append(pos - prev)
+            if pos - prev <= WINDOW - n:
+                matched += 1
+            else:
+                missed += n
+        last[idx] = pos
+        pos += stream_bytes(n)
+    distances.sort()
+    return MatchStats(
+        repeats=len(distances),
+        matched=matched,
+        missed=missed,
+        median=distances[len(distances) // 2] if distances else 0,
+        max=distances[-1] if distances else 0,
+    )
+
+def order_clips(packets: Sequence[bytes],
+                clips: Sequence[Sequence[int]]) -> List[int]:
+    """Choose an order for clips which puts repeated packets closer together.
+
+    Starting with the first clip, the next clip is always the one with the
+    most bytes of repeated packets within the Deflate window of their
+    previous copies, with ties going to the clip that came first. The new
+    order is only used if estimate_deflate predicts that it is smaller.
+
+    Arguments:
+      packets: Encoded packets.
+      clips: Indexes of the packets in each clip, in order.
+    Returns:
+      The indexes of the clips, in the order to emit them.
+    """
+    if len(clips) <= 2:
+        return list(range(len(clips)))
+    last: Dict[int, int] = {}
+    pos = 0
+
+    def place(clip: Sequence[int], commit: bool) -> int:
+        """Return the bytes of matched packets if a clip is placed next."""
+        nonlocal pos
+        seen: Dict[int, int] = {}
+        p = pos
+        score = 0
+        for idx in clip:
+            n = len(packets[idx])
+            prev = seen.get(idx)
+            if prev is None:
+                prev = last.get(idx)
+            if prev is not None and p - prev <= WINDOW - n:
+                score += n
+            seen[idx] = p
+            p += stream_bytes(n)
+        if commit:
+            last.update(seen)
+            pos = p
+        return score
+
+    result = [0]
+    place(clips[0], True)
+    remaining = list(range(1, len(clips)))
+    while remaining:
+        best = max(remaining, key=lambda c: (place(clips[c], False), -c))
+        remaining.remove(best)
+        result.append(best)
+        place(clips[best], True)
+
+    def size(corder: List[int]) -> int:
+        return estimate_deflate(
+            packets, [idx for c in corder for idx in clips[c]])
+
+    original = list(range(len(clips)))
+    if size(result) < size(original):
+        return result
+    return original
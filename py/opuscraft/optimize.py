@@ -0,0 +1,329 @@
+import argparse
+import os
+import sys
+import zlib
+
+import numpy
+
+from . import audio
+from . import estimate
+from . import opus
+
+from typing import List, Tuple
+
+# Version of the optimal_packets algorithm. Changing this discards the
+# layouts stored in the plan cache.
+OPTIMAL_VERSION = 1
+
+# Number of frequency bands in packet feature vectors.
+NUM_BANDS = 24
+
+# Highest frequency in packet feature vectors, in Hz. This is the edge of the
+# narrowband mode that packets are encoded with by default.
+MAX_FREQUENCY = 4000
+
+def packet_features(data: numpy.ndarray, size: int) -> numpy.ndarray:
+    """Return spectral feature vectors for consecutive packets of audio.
+
+    Each feature vector contains the log energy in bands spaced evenly on the
+    mel scale.
+
+    Arguments:
+      data: The audio data, in float32 format.
+      size: Length of each packet, in samples.
+    """
+    n = len(data) // size
+    frames = numpy.asarray(data[:n*size], dtype=numpy.float64).reshape(n, size)
+    power = numpy.abs(numpy.fft.rfft(frames * numpy.hanning(size), axis=1))**2
+    freqs = numpy.fft.rfftfreq(size, 1 / 48000)
+    mel = 2595 * numpy.log10(1 + freqs / 700)
+    mel_max = 2595 * numpy.log10(1 + MAX_FREQUENCY / 700)
+    band = numpy.minimum((mel * (NUM_BANDS / mel_max)).astype(int), NUM_BANDS)
+    energy = numpy.zeros((n, NUM_BANDS + 1))
+    for i in range(NUM_BANDS + 1):
+        energy[:,i] = power[:,band == i].sum(axis=1)
+    return numpy.log10(energy[:,:NUM_BANDS] + 1e-9).astype(numpy.float32)
+
+def distance_matrix(features: numpy.ndarray) -> numpy.ndarray:
+    """Return the squared Euclidean distance between all feature vectors."""
+    sq = numpy.einsum("ij,ij->i", features, features)
+    dist = sq[:,None] + sq[None,:] - 2 * (features @ features.T)
+    numpy.maximum(dist, 0, out=dist)
+    return dist
+
+def k_medoids(dist: numpy.ndarray, k: int,
+              iterations: int = 50) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """Cluster points into k clusters.
+
+    The first medoid is the point closest to all others, and each following
+    medoid is the point farthest from the medoids chosen so far. The medoids
+    are then refined by alternating between assigning points to the nearest
+    medoid and moving each medoid to the point closest to the rest of its
+    cluster. This is deterministic.
+
+    Arguments:
+      dist: Distance matrix between points.
+      k: Number of clusters.
+    Returns:
+      A tuple (medoids, labels), where medoids contains the index of each
+      cluster's medoid and labels contains the cluster of each point.
+    """
+    n = len(dist)
+    k = max(1, min(k, n))
+    medoids = [int(numpy.argmin(dist.sum(axis=0)))]
+    nearest = dist[medoids[0]].copy()
+    for _ in range(k - 1):
+        m = int(numpy.argmax(nearest))
+        medoids.append(m)
+        numpy.minimum(nearest, dist[m], out=nearest)
+    marr = numpy.array(medoids)
+    for _ in range(iterations):
+        labels = numpy.argmin(dist[:,marr], axis=1)
+        new = marr.copy()
+        for i in range(len(marr)):
+            members = numpy.flatnonzero(labels == i)
+            if len(members):
+                cost = dist[numpy.ix_(members, members)].sum(axis=0)
+                new[i] = members[numpy.argmin(cost)]
+        if numpy.array_equal(new, marr):
+            break
+        marr = new
+    labels = numpy.argmin(dist[:,marr], axis=1)
+    return marr, labels
+
+def deflate_size(data: bytes) -> int:
+    """Return the size of data after Deflate compression."""
+    obj = zlib.compressobj(9, zlib.DEFLATED, -15, 9)
+    return len(obj.compress(data)) + len(obj.flush())
+
+def clustered_stream(packets: numpy.ndarray, medoids: numpy.ndarray,
+                     labels: numpy.ndarray) -> audio.Stream:
+    """Create a stream where each packet is replaced by its cluster's medoid."""
+    stream = audio.Stream()
+    stream.extend(packets[medoids[labels]])
+    return stream
+
+def optimize(data: numpy.ndarray, budget: int, *,
+             size: int = 960,
+             verbose: bool = True) -> Tuple[audio.Stream, int]:
+    """Create a stream from audio which fits in a compressed size budget.
+
+    Every packet in the audio is replaced by a representative packet from a
+    cluster of packets with similar spectra, so the compressor sees repeated
+    packets. The number of clusters is the largest that fits in the budget,
+    found by binary search using the estimated compressed size.
+
+    Arguments:
+      data: The audio data, in float32 format.
+      budget: Target size of the Opus file after Deflate compression, in bytes.
+      size: Length of each packet, in samples.
+    Returns:
+      A tuple (stream, size) containing the stream and the size of the
+      stream after Deflate compression, measured with zlib.
+    """
+    if size not in audio.LENGTHS:
+        raise ValueError("invalid packet length")
+    n = len(data) // size
+    if n == 0:
+        raise ValueError("audio is shorter than one packet")
+    packets = audio.PACKETS.add_audio(data, [size] * n)
+    dist = distance_matrix(packet_features(data, size))
+
+    def evaluate(k: int) -> Tuple[audio.Stream, int]:
+        medoids, labels = k_medoids(dist, k)
+        stream = clustered_stream(packets, medoids, labels)
+        csize = stream.estimate_size()
+        if verbose:
+            print("    {:6} clusters  {:8} bytes (estimated)"
+                  .format(len(medoids), csize),
+                  file=sys.stderr)
+        return stream, csize
+
+    lo, hi = 1, n
+    best = evaluate(lo)
+    if best[1] <= budget:
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            result = evaluate(mid)
+            if result[1] <= budget:
+                lo = mid
+                best = result
+            else:
+                hi = mid - 1
+    stream = best[0]
+    return stream, deflate_size(stream.encode_bytes())
+
+# Spacing of the packet boundaries that optimal_packets considers, in samples.
+# This is the shortest packet length.
+GRID = 120
+
+# Largest sample magnitude which optimal_packets treats as silence.
+SILENCE = 1 / 32768
+
+def optimal_packets(data: numpy.ndarray, start: int, length: int,
+                    shift: int = 0) -> Tuple[int, List[int]]:
+    """Choose the packet lengths for a span of audio with the smallest size.
+
+    The span is covered with packets of any length in audio.LENGTHS, and its
+    start may move by up to shift samples in either direction, in steps of
+    GRID samples. Since the encoder carries state from one packet to the
+    next, and switching between packet lengths is expensive, each packet is
+    encoded as a trial after each length of packet that could come before
+    it. The cheapest layout is then found by dynamic programming over the
+    packet boundaries and the length of the last packet. Trials are encoded
+    in a private packet table and are not cached, since they are only used
+    for planning.
+
+    The cost of a packet is its size if Deflate codes it as literals, from
+    the order-0 entropy of all the trial packets, plus its Ogg segment table
+    entries. This ignores matches between packets, which make the real size
+    smaller, so it ranks layouts rather than predicting the final size.
+    Packets which encode to no data are only used for silence, since at low
+    bitrates the shortest packets are encoded with no data at all.
+
+    Arguments:
+      data: The audio data, in 48 kHz float32 format.
+      start: Start of the span, in samples.
+      length: Length of the span, in samples. Any remainder shorter than
+        GRID is left out, and so is the end of the span if no layout fills
+        it, which can happen if the shortest packets are left out.
+      shift: Largest distance to move the start, in samples.
+    Returns:
+      A tuple (start, sizes) containing the chosen start and the length of
+      each packet.
+    """
+    audio.extract_clip(data, start, length)
+    if not opus.available():
+        raise ValueError("libopus is not available")
+    nsteps = length // GRID
+    if nsteps == 0:
+        return start, []
+    nshift = shift // GRID
+    first = start - min(nshift, start // GRID) * GRID
+    last = start + min(nshift, (len(data) - start - nsteps * GRID) // GRID) \
+        * GRID
+    norigin = (last - first) // GRID + 1
+    npos = norigin + nsteps
+    steps = [size // GRID for size in audio.LENGTHS]
+    nk = len(steps)
+
+    # Encode every packet that fits between two grid points, after each
+    # packet that can come before it. Packets that can start the span are
+    # also encoded on their own, with index nk in place of the previous
+    # packet.
+    table = audio.PacketTable()
+    encoder = opus.Encoder()
+    trials: List[Tuple[int, int, int]] = []
+    tdata: List[bytes] = []
+    for k, step in enumerate(steps):
+        for pos in range(npos - step):
+            offset = first + pos * GRID
+            runs: List[Tuple[int, numpy.ndarray]] = []
+            if pos < norigin:
+                runs.append((nk, table.add_audio(
+                    data[offset:offset+step*GRID], [step * GRID])))
+            for j, pstep in enumerate(steps):
+                if pos >= pstep:
+                    runs.append((j, table.add_audio(
+                        data[offset-pstep*GRID:offset+step*GRID],
+                        [pstep * GRID, step * GRID])))
+            for j, run in runs:
+                encoder.reset()
+                for idx in run.tolist():
+                    pdata = table.encode(idx, encoder)
+                trials.append((pos, j, k))
+                tdata.append(pdata)
+    cost = numpy.full((npos, nk + 1, nk), numpy.inf)
+    for (pos, j, k), pbits, pdata in zip(
+            trials, estimate.literal_bits(tdata), tdata):
+        # A packet with no frame data decodes as silence, which is only
+        # right if the audio is silent.
+        if len(pdata) <= 1:
+            offset = first + pos * GRID
+            if numpy.abs(data[offset:offset+steps[k]*GRID]).max() > SILENCE:
+                continue
+        cost[pos, j, k] = pbits + \
+            estimate.SEGMENT_BITS * (len(pdata) // 255 + 1)
+
+    # Try each start, nearest to the original first, keeping the first of
+    # any starts with the same cost.
+    order = sorted(range(norigin),
+                   key=lambda pos: abs(first + pos * GRID - start))
+    best: Tuple[Tuple[int, float], int, List[int]] = \
+        ((1, 0.0), start, [])
+    for origin in order:
+        # total[n,k] is the cost of reaching grid point n from the origin
+        # with a packet of length k last, and choice[n,k] is the length of
+        # the packet before it.
+        total = numpy.full((nsteps + 1, nk), numpy.inf)
+        choice = numpy.full((nsteps + 1, nk), nk)
+        for k, step in enumerate(steps):
+            if step <= nsteps:
+                total[step, k] = cost[origin, nk, k]
+        for n in range(1, nsteps):
+            for k, step in enumerate(steps):
+                m = n + step
+                if m > nsteps:
+                    break
+                c = total[n] + cost[origin + n, :nk, k]
+                j = int(numpy.argmin(c))
+                if c[j] < total[m, k]:
+                    total[m, k] = c[j]
+                    choice[m, k] = j
+        # If no layout fills the span, because the shortest packets were
+        # left out, fill as much of it as possible.
+        end = nsteps
+        while end and numpy.isinf(total[end]).all():
+            end -= 1
+        k = int(numpy.argmin(total[end]))
+        ocost = (-end, float(total[end, k]))
+        if ocost < best[0]:
+            sizes: List[int] = []
+            n = end
+            while n:
+                sizes.append(audio.LENGTHS[k])
+                n, k = n - steps[k], int(choice[n, k])
+            sizes.reverse()
+            best = ocost, first + origin * GRID, sizes
+    return best[1], best[2]
+
+def main() -> None:
+    p = argparse.ArgumentParser(
+        description="Compress audio to fit a compressed size budget.")
+    p.add_argument("input", help="input audio file")
+    p.add_argument("output", help="output Opus file")
+    p.add_argument("--size", type=int, required=True,
+                   help="target size after Deflate, in bytes")
+    p.add_argument("--start", type=float, default=0,
+                   help="start of clip in input, in ms")
+    p.add_argument("--length", type=float,
+                   help="length of clip in input, in ms")
+    p.add_argument("--packet", type=float, default=20,
+                   help="packet length, in ms")
+    args = p.parse_args()
+
+    if not opus.available():
+        print("Error: libopus is not available", file=sys.stderr)
+        raise SystemExit(1)
+    data = audio.load_audio(args.input)
+    start = round(args.start * 48)
+    end = len(data)
+    if args.length is not None:
+        end = min(end, start + round(args.length * 48))
+    try:
+        stream, csize = optimize(data[start:end], args.size,
+                                 size=round(args.packet * 48))
+    except ValueError as ex:
+        print("Error: {}".format(ex), file=sys.stderr)
+        raise SystemExit(1)
+    out_dir = os.path.dirname(args.output)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    stream.encode(args.output)
+    print("Wrote {}: {} packets, {} unique, {} bytes after Deflate"
+          .format(args.output, stream.count,
+                  len(numpy.unique(stream.packets)), csize),
+          file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+import ctypes
+import ctypes.util
+import os
+import struct
+
+import numpy
+
+from typing import IO, List, Optional, Sequence
+
+# Constants from opus_defines.h.
+APPLICATION_AUDIO = 2049
+SET_BITRATE_REQUEST = 4002
+SET_BANDWIDTH_REQUEST = 4008
+SET_PREDICTION_DISABLED_REQUEST = 4042
+RESET_STATE = 4028
+
+BANDWIDTHS = {
+    "NB": 1101,
+    "MB": 1102,
+    "WB": 1103,
+    "SWB": 1104,
+    "FB": 1105,
+}
+
+# Maximum size of an encoded packet, the same buffer size opustool uses.
+MAX_PACKET = 4096
+
+class OpusError(Exception):
+    """Error from libopus."""
+
+LIBRARY: Optional[ctypes.CDLL] = None
+LIBRARY_LOADED = False
+
+def get_library() -> Optional[ctypes.CDLL]:
+    """Load libopus, returning None if it is not available.
+
+    The library path can be overridden with $OPUSCRAFT_LIBOPUS.
+    """
+    global LIBRARY, LIBRARY_LOADED
+    if LIBRARY_LOADED:
+        return LIBRARY
+    LIBRARY_LOADED = True
+    path = os.environ.get("OPUSCRAFT_LIBOPUS") or ctypes.util.find_library(
+        "opus")
+    if not path:
+        return None
+    try:
+        lib = ctypes.CDLL(path)
+    except OSError:
+        return None
+    lib.opus_encoder_create.argtypes = [
+        ctypes.c_int32, ctypes.c_int, ctypes.c_int,
+        ctypes.POINTER(ctypes.c_int)]
+    lib.opus_encoder_create.restype = ctypes.c_void_p
+    lib.opus_encoder_destroy.argtypes = [ctypes.c_void_p]
+    lib.opus_encoder_destroy.restype = None
+    lib.opus_encode_float.argtypes = [
+        ctypes.c_void_p, ctypes.POINTER(ctypes.c_float), ctypes.c_int,
+        ctypes.c_char_p, ctypes.c_int32]
+    lib.opus_encode_float.restype = ctypes.c_int32
+    lib.opus_encoder_ctl.restype = ctypes.c_int
+    lib.opus_strerror.argtypes = [ctypes.c_int]
+    lib.opus_strerror.restype = ctypes.c_char_p
+    lib.opus_get_version_string.argtypes = []
+    lib.opus_get_version_string.restype = ctypes.c_char_p
+    LIBRARY = lib
+    return lib
+
+def available() -> bool:
+    """Return True if libopus can be used for encoding."""
+    return get_library() is not None
+
+def version() -> str:
+    """Return the libopus version string."""
+    lib = get_library()
+    assert lib is not None
+    return lib.opus_get_version_string().decode("UTF-8", "replace")
+
+def strerror(code: int) -> str:
+    lib = get_library()
+    assert lib is not None
+    return lib.opus_strerror(code).decode("UTF-8", "replace")
+
+class Encoder:
+    """A mono 48 kHz Opus encoder, configured like the one in opustool."""
+
+    def __init__(self) -> None:
+        lib = get_library()
+        if lib is None:
+            raise OpusError("libopus is not available")
+        self.lib = lib
+        error = ctypes.c_int()
+        self.enc = lib.opus_encoder_create(
+            48000, 1, APPLICATION_AUDIO, ctypes.byref(error))
+        if not self.enc:
+            raise OpusError("could not create Opus encoder: {}"
+                            .format(strerror(error.value)))
+        self.buf = ctypes.create_string_buffer(MAX_PACKET)
+
+    def __del__(self) -> None:
+        enc = getattr(self, "enc", None)
+        if enc:
+            self.lib.opus_encoder_destroy(enc)
+            self.enc = None
+
+    def ctl(self, request: int, *args: int) -> None:
+        r = self.lib.opus_encoder_ctl(
+            ctypes.c_void_p(self.enc), ctypes.c_int(request),
+            *(ctypes.c_int(arg) for arg in args))
+        if r < 0:
+            raise OpusError("encoder control {} failed: {}"
+                            .format(request, strerror(r)))
+
+    def reset(self) -> None:
+        """Reset the encoder to its initial state."""
+        self.ctl(RESET_STATE)
+
+    def encode(self, data: numpy.ndarray, *,
+               bitrate: int, bandwidth: str, independent: bool) -> bytes:
+        """Encode one packet of 48 kHz float32 audio."""
+        try:
+            bwvalue = BANDWIDTHS[bandwidth]
+        except KeyError:
+            raise ValueError("invalid bandwidth {!r}".format(bandwidth))
+        self.ctl(SET_BITRATE_REQUEST, bitrate)
+        self.ctl(SET_BANDWIDTH_REQUEST, bwvalue)
+        self.ctl(SET_PREDICTION_DISABLED_REQUEST, int(independent))
+        data = numpy.ascontiguousarray(data, dtype=numpy.float32)
+        n = self.lib.opus_encode_float(
+            self.enc, data.ctypes.data_as(ctypes.POINTER(ctypes.c_float)),
+            len(data), self.buf, MAX_PACKET)
+        if n < 0:
+            raise OpusError("could not encode Opus data: {}"
+                            .format(strerror(n)))
+        return self.buf.raw[:n]
+
+################################################################################
+# Ogg
+################################################################################
+
+def make_crc_table() -> List[int]:
+    table = []
+    for i in range(256):
+        r = i << 24
+        for _ in range(8):
+            if r & 0x80000000:
+                r = ((r << 1) ^ 0x04c11db7) & 0xffffffff
+            else:
+                r = (r << 1) & 0xffffffff
+        table.append(r)
+    return table
+
+CRC_TABLE = make_crc_table()
+
+def ogg_crc(data: bytes) -> int:
+    """Return the CRC-32 used in Ogg page headers."""
+    crc = 0
+    table = CRC_TABLE
+    for c in data:
+        crc = ((crc << 8) & 0xffffffff) ^ table[(crc >> 24) ^ c]
+    return crc
+
+class OggStream:
+    """An Ogg logical bitstream being written to a file.
+
+    Pages are laid out the same way that libogg's ogg_stream_flush_fill lays
+    them out, so the output matches what opustool writes.
+    """
+
+    def __init__(self, fp: IO[bytes], serialno: int) -> None:
+        self.fp = fp
+        self.serialno = serialno
+        self.pageno = 0
+        self.bos = False
+        self.eos = False
+        # Lacing values, with 0x100 set on the first segment of each packet.
+        self.lacing: List[int] = []
+        self.granule: List[int] = []
+        self.body = bytearray()
+
+    def packetin(self, data: bytes, granulepos: int,
+                 eos: bool = False) -> None:
+        """Add a packet to the stream."""
+        n = len(data)
+        start = len(self.lacing)
+        self.lacing.extend(255 for _ in range(n // 255))
+        self.lacing.append(n % 255)
+        self.lacing[start] |= 0x100
+        self.granule.extend(granulepos for _ in range(n // 255 + 1))
+        self.body += data
+        if eos:
+            self.eos = True
+
+    def flush(self, fill: int = 1 << 15) -> None:
+        """Write all buffered packets as pages."""
+        while self.lacing:
+            self.write_page(fill)
+
+    def write_page(self, fill: int) -> None:
+        lacing = self.lacing
+        maxvals = min(len(lacing), 255)
+        granulepos = -1
+        vals = 0
+        if not self.bos:
+            # The first page contains only the first packet.
+            granulepos = 0
+            while vals < maxvals:
+                vals += 1
+                if (lacing[vals-1] & 0xff) < 255:
+                    break
+        else:
+            acc = 0
+            packets_done = 0
+            packet_just_done = 0
+            while vals < maxvals:
+                if acc > fill and packet_just_done >= 4:
+                    break
+                val = lacing[vals] & 0xff
+                acc += val
+                if val < 255:
+                    granulepos = self.granule[vals]
+                    packets_done += 1
+                    packet_just_done = packets_done
+                else:
+                    packet_just_done = 0
+                vals += 1
+        flags = 0
+        if not lacing[0] & 0x100:
+            flags |= 0x01
+        if not self.bos:
+            flags |= 0x02
+        if self.eos and len(lacing) == vals:
+            flags |= 0x04
+        self.bos = True
+        segments = bytes(val & 0xff for val in lacing[:vals])
+        size = sum(segments)
+        header = bytearray(struct.pack(
+            "<4sBBqIIIB",
+            b"OggS",
+            0, # version
+            flags,
+            granulepos,
+            self.serialno,
+            self.pageno,
+            0, # crc-32
+            vals,
+        ))
+        header += segments
+        body = bytes(self.body[:size])
+        struct.pack_into("<I", header, 22, ogg_crc(bytes(header) + body))
+        self.fp.write(header)
+        self.fp.write(body)
+        self.pageno += 1
+        del lacing[:vals]
+        del self.granule[:vals]
+        del self.body[:size]
+
+OPUS_HEAD = b"OpusHead" + struct.pack(
+    "<BBHIhB",
+    1, # version
+    1, # channel count
+    0, # preskip
+    0, # sample rate
+    0, # gain
+    0, # mapping family
+)
+
+OPUS_TAGS = b"OpusTags" + struct.pack(
+    "<II",
+    0, # vendor string length
+    0, # user comment list length
+)
+
+def write_opus(fp: IO[bytes], packets: Sequence[bytes],
+               sizes: Sequence[int], order: Sequence[int]) -> None:
+    """Write an Ogg Opus file.
+
+    The end of stream flag is set on the last packet in the order, so it
+    appears on the last page. Opustool marks the packet at position
+    len(packets) - 1 in the order instead, but libogg only sets the flag on
+    the page which flushes the end of the stream, so the output is the same
+    as long as every packet is emitted at least once.
+
+    Arguments:
+      fp: Output file.
+      packets: Encoded packets.
+      sizes: Length of each packet, in samples.
+      order: Indexes of the packets to emit, in order.
+    """
+    stream = OggStream(fp, 1)
+    stream.packetin(OPUS_HEAD, 0)
+    stream.flush()
+    stream.packetin(OPUS_TAGS, 0)
+    stream.flush()
+    pos = 0
+    for n, idx in enumerate(order):
+        pos += sizes[idx]
+        stream.packetin(packets[idx], pos, n == len(order) - 1)
+    stream.flush()
@@ -1,17 +1,29 @@
+import argparse
+import concurrent.futures
+import hashlib
 import json
 import os
 import sys
+import time
+import traceback
 
-import numpy
+from . import cache
+from . import timing
+from . import watcher
 
-from . import analyze
-from . import audio
-
-from abc import ABCMeta, abstractmethod
+from abc import ABCMeta
 from typing import (
-    Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple,
+    TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator, List, Optional,
+    Set, Tuple,
 )
 
+# NumPy, SciPy, and the modules which use them are imported when they are
+# first needed, so scripts can be checked without loading them.
+if TYPE_CHECKING:
+    import numpy
+    from . import audio
+    from .sound import Sound
+
 class ScriptError(Exception):
     """Script execution error."""
     def __init__(self, msg: str,
@@ -21,6 +33,88 @@ class ScriptError(Exception):
         self.filename = filename
         self.lineno = lineno
 
+# Version of the compiled script format. Changing this causes every script to
+# be compiled again.
+IR_VERSION = 2
+
+# Version of the dependency file format and of the way outputs are built.
+# Changing this causes every output to be rebuilt.
+DEPS_VERSION = 1
+
+class Dependencies:
+    """The inputs and sounds which part of a script depends on.
+
+    Attributes:
+      kind: The kind of thing which has these dependencies, "sound", "word",
+        or "output".
+      inputs: Paths of input files used.
+      sounds: Names of sounds from input files used.
+      words: Names of words used.
+      hash: Hash of the contents of everything used.
+    """
+    kind: str
+    inputs: Set[str]
+    sounds: Set[str]
+    words: Set[str]
+
+    def __init__(self, kind: str, *parts: str) -> None:
+        self.kind = kind
+        self.inputs = set()
+        self.sounds = set()
+        self.words = set()
+        self.hash = hashlib.sha256()
+        self.add_text(kind, *parts)
+
+    def add_text(self, *parts: str) -> None:
+        for part in parts:
+            self.hash.update(part.encode("UTF-8"))
+            self.hash.update(b"\0")
+
+    def use(self, name: str, deps: "Dependencies", *parts: str) -> None:
+        """Record a use of a sound or word."""
+        self.inputs.update(deps.inputs)
+        self.sounds.update(deps.sounds)
+        self.words.update(deps.words)
+        if deps.kind == "word":
+            self.words.add(name)
+        else:
+            self.sounds.add(name)
+        self.add_text(deps.digest(), *parts)
+
+    def digest(self) -> str:
+        return self.hash.hexdigest()
+
+class Memo:
+    """Results which are kept from one run of a script to the next.
+
+    In watch mode, the same memo is passed to each run, so unchanged inputs
+    are not decoded again and unchanged sounds are not extracted again.
+
+    Attributes:
+      inputs: Map from input path to the hash of the file contents and the
+        decoded audio.
+      sounds: Map from the hash of a sound's dependencies to the sound.
+    """
+    inputs: Dict[str, Tuple[str, "numpy.ndarray"]]
+    sounds: Dict[str, "Sound"]
+
+    def __init__(self) -> None:
+        self.inputs = {}
+        self.sounds = {}
+
+    def collect(self) -> None:
+        """Free the packets which are not used by any remembered sound.
+
+        Otherwise the packet table would grow with every run, and keep the
+        audio of inputs which are no longer used in memory.
+        """
+        from . import audio
+        mapping = audio.collect(
+            [arr for sound in self.sounds.values()
+             for arr in sound.packet_arrays()])
+        for sound in self.sounds.values():
+            sound.remap(mapping)
+
 class State:
     """The state of the script executor.
 
@@ -28,70 +122,180 @@ class State:
       base_path: Path to directory containing script.
       sounds: Map from sound name to individual sounds.
       groups: List of groups being executed, outermost first.
+      inputs: Map from input path to pending decoded audio.
+      input_hashes: Map from input path to hash of the file contents.
+      deps: Map from sound name to the dependencies of the sound.
+      deps_path: Path to the file which records the dependencies of each
+        output, or None. Outputs whose dependencies and encoder are unchanged
+        since the last run are not rebuilt.
+      prev_outputs: Recorded dependencies of outputs from the last run.
+      outputs: Recorded dependencies of outputs from this run.
+      memo: Results kept from previous runs.
+      used_sounds: Hashes of the dependencies of sounds used in this run.
     """
     base_path: str
-    sounds: Dict[str, Optional["Sound"]]
+    sounds: Dict[str, "Sound"]
     groups: List["Group"]
+    inputs: Dict[str, "concurrent.futures.Future[numpy.ndarray]"]
+    input_hashes: Dict[str, str]
+    deps: Dict[str, Dependencies]
+    deps_path: Optional[str]
+    prev_outputs: Dict[str, Any]
+    outputs: Dict[str, Any]
+    memo: Memo
+    used_sounds: Set[str]
 
-    def __init__(self, base_path: str) -> None:
+    def __init__(self, base_path: str,
+                 deps_path: Optional[str] = None,
+                 memo: Optional[Memo] = None) -> None:
         self.base_path = base_path
         self.sounds = {}
         self.groups = []
+        self.inputs = {}
+        self.input_hashes = {}
+        self.deps = {}
+        self.deps_path = deps_path
+        self.prev_outputs = {}
+        self.outputs = {}
+        self.memo = memo if memo is not None else Memo()
+        self.used_sounds = set()
+        if deps_path is not None:
+            self.load_deps(deps_path)
 
-    def run(self, lines: Iterable[str]) -> None:
-        for lineno, line in enumerate(lines, 1):
-            line = line.strip()
-            if not line or line.startswith("#"):
-                continue
-            cmd_name, *args = line.split()
-            if cmd_name == '.':
-                func_name = 'command'
-            else:
-                func_name = 'command_' + cmd_name
-            group: Any = self
-            if self.groups:
-                group = self.groups[-1]
-            func = getattr(group, func_name, None)
-            if func is None:
-                raise ScriptError("Unknown command {!r}".format(cmd_name),
-                                  lineno=lineno)
+    def load_deps(self, path: str) -> None:
+        try:
+            with open(path) as fp:
+                obj = json.load(fp)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            print("Warning: ignoring invalid dependency file {}".format(path),
+                  file=sys.stderr)
+            return
+        if obj.get("version") == DEPS_VERSION:
+            self.prev_outputs = obj.get("outputs", {})
+
+    def save_deps(self, path: str) -> None:
+        obj = {
+            "version": DEPS_VERSION,
+            "outputs": self.outputs,
+        }
+        tpath = path + ".tmp"
+        with timing.span("deps", "write", path=path):
+            with open(tpath, "w") as fp:
+                json.dump(obj, fp, indent=True, sort_keys=True)
+            os.replace(tpath, path)
+
+    def run(self, program: "Program") -> None:
+        """Run a compiled script."""
+        executor = concurrent.futures.ThreadPoolExecutor()
+        with timing.span("run", "script"):
             try:
-                func(args)
+                self.start_inputs(executor, program)
+                self.execute(program)
+            except BaseException:
+                # Stop decoding inputs which are no longer needed. Inputs
+                # which have started decoding cannot be stopped, but there is
+                # no need to wait for them before reporting the error.
+                # Python 3.6 has no shutdown(cancel_futures=True).
+                for future in self.inputs.values():
+                    future.cancel()
+                executor.shutdown(wait=False)
+                raise
+            finally:
+                self.inputs.clear()
+            executor.shutdown()
+        if self.deps_path is not None:
+            self.save_deps(self.deps_path)
+        memo = self.memo
+        memo.inputs = {path: value for path, value in memo.inputs.items()
+                       if path in self.input_hashes}
+        memo.sounds = {key: sound for key, sound in memo.sounds.items()
+                       if key in self.used_sounds}
+
+    def start_inputs(self, executor: concurrent.futures.Executor,
+                     program: "Program") -> None:
+        """Start decoding every input file used by the script."""
+        for path in program.input_paths():
+            if path not in self.inputs:
+                self.inputs[path] = executor.submit(self.load_input, path)
+
+    def load_input(self, path: str) -> "numpy.ndarray":
+        """Load an input file, reusing the audio from the memo if unchanged."""
+        from . import audio
+        full_path = os.path.join(self.base_path, path)
+        fhash = cache.file_hash(full_path)
+        value = self.memo.inputs.get(path)
+        if value is not None and value[0] == fhash:
+            return value[1]
+        with timing.span(path, "input"):
+            data = audio.load_audio(full_path)
+        self.memo.inputs[path] = fhash, data
+        return data
+
+    def execute(self, program: "Program") -> None:
+        """Execute the operations in a compiled script."""
+        handlers: Dict[str, Callable[..., None]] = {
+            "input": self.begin_input,
+            "word": self.begin_word,
+            "output": self.begin_output,
+            "clip": self.begin_clip,
+            "sound": self.add_sound,
+            "use": self.use,
+            "end": self.end,
+        }
+        profiling = timing.PROFILER is not None
+        for lineno, opcode, *args in program.ops:
+            handler = handlers[opcode]
+            try:
+                if profiling:
+                    with timing.span(opcode, "command",
+                                     at="line {}".format(lineno)):
+                        handler(*args)
+                else:
+                    handler(*args)
             except ScriptError as ex:
                 ex.lineno = lineno
                 raise
             except Exception:
                 print("At line {}".format(lineno), file=sys.stderr)
                 raise
-        if self.groups:
-            raise ScriptError("Unclosed group: {}"
-                              .format(self.groups[-1].__class__.__name__),
-                              lineno=lineno)
 
-    def command_input(self, args: List[str]) -> None:
-        try:
-            path, = args
-        except ValueError:
-            raise ScriptError("Invalid input command")
-        data = audio.load_audio(os.path.join(self.base_path, path))
-        self.groups.append(InputGroup(self, data))
+    def begin_input(self, path: str) -> None:
+        future = self.inputs.get(path)
+        if future is not None:
+            data = future.result()
+        else:
+            data = self.load_input(path)
+        self.input_hashes[path] = self.memo.inputs[path][0]
+        self.groups.append(InputGroup(self, data, path))
 
-    def command_word(self, args: List[str]) -> None:
-        try:
-            name, = args
-        except ValueError:
-            raise ScriptError("Invalid word command")
-        if name in self.sounds:
-            raise ScriptError("Duplicate sound name {!r}".format(name))
-        self.sounds[name] = None
+    def begin_word(self, name: str) -> None:
         self.groups.append(WordGroup(self, name))
 
-    def command_output(self, args: List[str]) -> None:
-        try:
-            path, = args
-        except ValueError:
-            raise ScriptError("Invalid output command")
-        self.groups.append(OutputGroup(self, path))
+    def begin_output(self, path: str, reorder: bool) -> None:
+        self.groups.append(OutputGroup(self, path, reorder))
+
+    # The compiler only emits these operations inside the right kind of
+    # group, so the checks below never fail.
+
+    def begin_clip(self, name: str) -> None:
+        group = self.groups[-1]
+        assert isinstance(group, OutputGroup)
+        group.begin_clip(name)
+
+    def add_sound(self, *args: Any) -> None:
+        group = self.groups[-1]
+        assert isinstance(group, InputGroup)
+        group.add_sound(*args)
+
+    def use(self, name: str, length: Optional[int]) -> None:
+        group = self.groups[-1]
+        assert isinstance(group, StreamGroup)
+        group.use(name, length)
+
+    def end(self) -> None:
+        self.groups[-1].end()
 
 ################################################################################
 # Groups
@@ -103,9 +307,7 @@ class Group(metaclass=ABCMeta):
     def __init__(self, state: State) -> None:
         self.state = state
 
-    def command_end(self, args: List[str]) -> None:
-        if args:
-            raise ScriptError("Unexpected argument")
+    def end(self) -> None:
         self.state.groups.pop()
 
 class InputGroup(Group):
@@ -113,172 +315,262 @@ class InputGroup(Group):
 
     Attributes:
       sounds: Sounds to add the input to.
-      data: Audio clip data, a 48 kHz float32 NumPy array.
+      data: Audio clip data, a memory-mapped 48 kHz float32 NumPy array.
+      path: Path to the input file, relative to the script.
+      key: Hash of the dependencies of the sound being added.
     """
 
-    def __init__(self, state: State, data: numpy.ndarray) -> None:
+    def __init__(self, state: State, data: "numpy.ndarray",
+                 path: str) -> None:
         super().__init__(state)
         self.data = data
+        self.path = path
+        self.key = ""
 
-    def command(self, args: List[str]) -> None:
-        try:
-            name, sstart, slength, method, *args = args
-            start = round(float(sstart) * 48)
-            length = round(float(slength) * 48)
-        except ValueError:
-            raise ScriptError("Invalid sound")
-        if name in self.state.sounds:
-            raise ScriptError("Duplicate sound {!r}".format(name))
-        func = getattr(self, "add_sound_" + method, None)
-        if func is None:
-            raise ScriptError("Unknown method {!r}".format(method))
-        sound = func(name, start, length, args)
-        assert sound
+    def add_sound(self, name: str, start: int, length: int, method: str,
+                  params: List[str], plan: Any) -> None:
+        """Add a sound from the input.
+
+        Arguments:
+          params: Parameters of the sound, as written in the script.
+          plan: Packet layout of the sound, from the planner for its method.
+        """
+        func = getattr(self, "add_sound_" + method)
+        deps = Dependencies(
+            "sound", self.state.input_hashes[self.path],
+            str(start), str(length), method, *params)
+        deps.inputs.add(self.path)
+        key = deps.digest()
+        self.key = key
+        sound = self.state.memo.sounds.get(key)
+        if sound is None:
+            with timing.span(method, "sound", sound=name):
+                sound = func(name, start, length, plan)
+            assert sound
+            self.state.memo.sounds[key] = sound
+        self.state.used_sounds.add(key)
         self.state.sounds[name] = sound
+        self.state.deps[name] = deps
 
-    def get_sound(self, start: int, length: int) -> List[audio.Packet]:
+    def get_sound(self, start: int, length: int,
+                  sizes: List[int]) -> "numpy.ndarray":
+        from . import audio
         try:
-            clip = analyze.extract_clip(self.data, start, length)
+            clip = audio.extract_clip(self.data, start, length)
         except ValueError as ex:
             raise ScriptError(str(ex))
-        pos = 0
-        packets: List[audio.Packet] = []
-        for length in packetize(length):
-            packets.append(audio.AudioPacket(
-                clip[pos:pos+length],
-                independent=not packets))
-            pos += length
-        return packets
+        return audio.PACKETS.add_audio(clip, sizes)
 
     def add_sound_once(self, name: str, start: int, length: int,
-                      args: List[str]) -> "Sound":
-        if args:
-            raise ScriptError("Unexpected sound parameter")
-        return OnceSound(self.get_sound(start, length))
+                      plan: List[int]) -> "Sound":
+        from .sound import OnceSound
+        return OnceSound(self.get_sound(start, length, plan))
 
     def add_sound_looped(self, name: str, start: int, length: int,
-                        args: List[str]) -> "Sound":
-        if args:
-            raise ScriptError("Unexpected sound parameter")
-        return LoopedSound(self.get_sound(start, length))
+                        plan: List[int]) -> "Sound":
+        from .sound import LoopedSound
+        return LoopedSound(self.get_sound(start, length, plan))
 
     def add_sound_pitched(self, name: str, start: int, length: int,
-                         args: List[str]) -> "Sound":
-        try:
-            ssizes, = args
-        except ValueError:
-            raise ScriptError("Expected one sound parameter")
-        sizes: List[int] = []
-        for ssize in ssizes.split(","):
-            i = ssize.find('x')
-            try:
-                if i == -1:
-                    n = 1
-                    v = int(ssize)
-                else:
-                    n = int(ssize[:i])
-                    v = int(ssize[i+1:])
-            except ValueError:
-                raise ScriptError("Invalid segment size {!r}".format(ssize))
-            if n <= 0 or v <= 0:
-                raise ScriptError("Invalid segment size {!r}".format(ssize))
-            v *= 48
-            sizes.extend(v for _ in range(n))
-        if sum(sizes) > length:
-            raise ScriptError("Segments are larger than enclosing clip")
-        pgroups = [list(packetize(size)) for size in sizes]
-        extra = sum(length for pgroup in pgroups for length in pgroup)
-        pos = 0
-        groups = []
-        for n, pgroup in enumerate(pgroups):
-            glen = sum(pgroup)
-            gpos = start + pos + (n+1)*extra//(len(pgroups)+1)
-            clip = analyze.extract_pitched(name, self.data, gpos, glen)
-            ppos = 0
-            group: List[audio.Packet] = []
-            for length in pgroup:
-                group.append(audio.AudioPacket(
-                    clip[ppos:ppos+length],
-                    independent=not group))
-                ppos += length
-            groups.append(group)
-            pos += glen
+                         plan: List[List[Any]]) -> "Sound":
+        from . import analyze
+        from . import audio
+        from .sound import StretchPitchSound
+        pgroups = [pgroup for gpos, pgroup in plan]
+        layout = [(gpos, sum(pgroup)) for gpos, pgroup in plan]
+        with timing.span("get_periods", "analyze", positions=len(layout)):
+            periods = analyze.get_periods(
+                self.data, [gpos + glen//2 for gpos, glen in layout])
+        with timing.span("extract_pitched", "analyze",
+                         segments=len(layout),
+                         samples=sum(glen for gpos, glen in layout)):
+            clips = analyze.extract_pitched_many(
+                name, self.data, layout, periods)
+        groups = [audio.PACKETS.add_audio(clip, pgroup)
+                  for clip, pgroup in zip(clips, pgroups)]
         return StretchPitchSound(groups)
 
+    def add_sound_optimal(self, name: str, start: int, length: int,
+                          plan: int) -> "Sound":
+        """Add a sound with the packet layout from optimize.optimal_packets.
+
+        Finding the layout takes much longer than encoding the sound, so
+        layouts are stored in the plan cache, keyed by the sound's
+        dependencies and the libopus version.
+        """
+        from . import opus
+        from . import optimize
+        from .sound import OnceSound
+        if not opus.available():
+            raise ScriptError("libopus is not available")
+        pcache = cache.plan_cache()
+        pkey = hashlib.sha256(" ".join([
+            "optimal", str(optimize.OPTIMAL_VERSION), opus.version(),
+            self.key]).encode("UTF-8")).hexdigest() + ".json"
+        layout = None
+        cpath = pcache.get(pkey) if pcache is not None else None
+        if cpath is not None:
+            try:
+                with open(cpath) as fp:
+                    obj = json.load(fp)
+                layout = int(obj["start"]), [int(n) for n in obj["sizes"]]
+            except (OSError, ValueError, KeyError, TypeError):
+                layout = None
+        if layout is None:
+            with timing.span("optimal_packets", "analyze", samples=length):
+                try:
+                    layout = optimize.optimal_packets(
+                        self.data, start, length, plan)
+                except ValueError as ex:
+                    raise ScriptError(str(ex))
+            if pcache is not None:
+                tpath = pcache.temp_path()
+                try:
+                    with open(tpath, "w") as fp:
+                        json.dump({"start": layout[0], "sizes": layout[1]},
+                                  fp)
+                    pcache.evict(pcache.put(pkey, tpath))
+                except BaseException:
+                    os.remove(tpath)
+                    raise
+        start, sizes = layout
+        return OnceSound(self.get_sound(start, sum(sizes), sizes))
+
 class StreamGroup(Group):
-    def __init__(self, state: State, stream: audio.Stream) -> None:
+    def __init__(self, state: State, stream: "audio.Stream",
+                 deps: Dependencies) -> None:
         super().__init__(state)
         self.stream = stream
+        self.deps = deps
 
-    def command(self, args: List[str]) -> None:
-        if not (1 <= len(args) <= 2):
-            raise ScriptError("Expected 1 or 2 arguments")
-        name = args[0]
-        try:
-            sound = self.state.sounds[name]
-        except KeyError:
-            raise ScriptError("Undefined sound {!r}".format(name))
-        if sound is None:
-            raise ScriptError("Cannot recursively use sound {!r}".format(name))
-        length: Optional[int] = None
-        if len(args) == 2 and args[1] != "-":
-            try:
-                length = int(args[1])
-            except ValueError:
-                raise ScriptError("Invalid length")
-            length *= 48
+    def use(self, name: str, length: Optional[int]) -> None:
+        sound = self.state.sounds[name]
         sound.emit(self.stream, length)
+        self.deps.use(name, self.state.deps[name], str(length))
 
 class WordGroup(StreamGroup):
     """A sequence of sounds in the script which can be reused as a unit."""
 
     def __init__(self, state: State, name: str) -> None:
-        super().__init__(state, audio.Stream())
+        from . import audio
+        super().__init__(state, audio.Stream(), Dependencies("word"))
         self.name = name
-        self.stream = audio.Stream()
 
-    def command_end(self, args: List[str]) -> None:
-        super().command_end(args)
+    def end(self) -> None:
+        from .sound import OnceSound
+        super().end()
         stream = self.stream
-        self.state.sounds[self.name] = OnceSound(stream.packets)
+        self.state.sounds[self.name] = OnceSound(stream.packets.copy())
+        self.state.deps[self.name] = self.deps
 
 class OutputGroup(Group):
-    """A group containing an output file."""
+    """A group containing an output file.
+
+    Attributes:
+      reorder: If true, clips may be written in a different order, so
+        repeated packets are closer together.
+      marks: The name and position of each clip, in samples.
+      starts: The index in the stream of each clip's first packet.
+    """
     out_path: str
-    stream: audio.Stream
+    reorder: bool
+    stream: "audio.Stream"
     marks: List[Tuple[str, int]]
-    mark_set: Set[str]
+    starts: List[int]
+    deps: Dependencies
 
-    def __init__(self, state: State, out_path: str) -> None:
+    def __init__(self, state: State, out_path: str, reorder: bool) -> None:
+        from . import audio
         super().__init__(state)
         self.out_path = out_path
+        self.reorder = reorder
         self.stream = audio.Stream()
         self.marks = []
-        self.mark_set = set()
+        self.starts = []
+        self.deps = Dependencies("output", str(DEPS_VERSION), out_path)
+        if reorder:
+            self.deps.add_text("reorder")
 
-    def command_clip(self, args: List[str]) -> None:
-        try:
-            name, = args
-        except ValueError:
-            raise ScriptError("Invalid clip command")
-        if name in self.mark_set:
-            raise ScriptError("Duplicate clip name {!r}".format(name))
-        self.state.groups.append(StreamGroup(self.state, self.stream))
+    def begin_clip(self, name: str) -> None:
+        self.state.groups.append(
+            StreamGroup(self.state, self.stream, self.deps))
         self.marks.append((name, self.stream.length))
-        self.mark_set.add(name)
+        self.starts.append(self.stream.count)
+        self.deps.add_text("clip", name)
 
-    def command_end(self, args: List[str]) -> None:
-        super().command_end(args)
-        print("Encoding {}".format(self.out_path))
+    def reorder_clips(self) -> None:
+        """Reorder the clips so repeated packets are closer together."""
+        from . import audio
+        from . import estimate
+        stream = self.stream
+        with timing.span("reorder", "output", clips=len(self.marks)):
+            plist, order = stream.program()
+            packets = audio.encode_packets(plist)
+            bounds = self.starts + [stream.count]
+            clips = [order[start:end].tolist()
+                     for start, end in zip(bounds, bounds[1:])]
+            corder = estimate.order_clips(packets, clips)
+            if corder == list(range(len(clips))):
+                return
+            new = audio.Stream()
+            marks: List[Tuple[str, int]] = []
+            starts: List[int] = []
+            for c in corder:
+                marks.append((self.marks[c][0], new.length))
+                starts.append(new.count)
+                new.extend(stream.packets[bounds[c]:bounds[c+1]])
+        print("Reordered clips: {}".format(
+            " ".join(name for name, mark in marks)))
+        self.stream = new
+        self.marks = marks
+        self.starts = starts
+
+    def end(self) -> None:
+        super().end()
+        from . import audio
+        from . import opus
+        deps = self.deps
+        record = {
+            "hash": deps.digest(),
+            "encoder": audio.encoder_id(),
+            "inputs": {path: self.state.input_hashes[path]
+                       for path in sorted(deps.inputs)},
+            "sounds": sorted(deps.sounds),
+            "words": sorted(deps.words),
+        }
+        self.state.outputs[self.out_path] = record
         out_path = os.path.join(self.state.base_path, self.out_path)
+        prev = self.state.prev_outputs.get(self.out_path)
+        if (prev is not None and prev.get("hash") == record["hash"] and
+                prev.get("encoder") == record["encoder"] and
+                os.path.exists(out_path) and
+                os.path.exists(out_path + ".json")):
+            print("Up to date {}".format(self.out_path))
+            return
+        print("Encoding {}".format(self.out_path))
+        if self.reorder:
+            if opus.available():
+                self.reorder_clips()
+            else:
+                print("Not reordering clips: libopus is not available",
+                      file=sys.stderr)
         os.makedirs(os.path.dirname(out_path), exist_ok=True)
-        self.stream.encode(out_path)
+        with timing.span(self.out_path, "output",
+                         packets=self.stream.count):
+            self.stream.encode(out_path)
+        if opus.available():
+            stats = self.stream.match_stats()
+            print("    {} repeated packets, {} within the window, "
+                  "{} bytes outside; median distance {}, max {}"
+                  .format(stats.repeats, stats.matched, stats.missed,
+                          stats.median, stats.max))
         obj = {
             "marks": [mark for name, mark in self.marks] + [self.stream.length],
             "names": [name for name, mark in self.marks],
         }
-        with open(out_path + ".json", "w") as fp:
-            json.dump(obj, fp, indent=True, sort_keys=True)
+        with timing.span("marks", "write", path=out_path + ".json"):
+            with open(out_path + ".json", "w") as fp:
+                json.dump(obj, fp, indent=True, sort_keys=True)
 
 ################################################################################
 # Sounds
@@ -293,121 +585,457 @@ def packetize(length: int) -> Iterator[int]:
             yield n
             length -= n
 
-class Sound(metaclass=ABCMeta):
-    """Abstract base class for sounds which can be reused to make new sounds."""
-    @abstractmethod
-    def emit(self, stream: audio.Stream, length: Optional[int]) -> None: pass
-
-class OnceSound(Sound):
-    def __init__(self, packets: List[audio.Packet]) -> None:
-        self.packets = packets
-    def emit(self, stream: audio.Stream, length: Optional[int]) -> None:
-        stream.extend(self.packets)
-
-class LoopedSound(Sound):
-    def __init__(self, packets: List[audio.Packet]) -> None:
-        self.packets = packets
-    def emit(self, stream: audio.Stream, length: Optional[int]) -> None:
-        if not self.packets:
-            print("NO")
-            return
-        if length is None:
-            stream.extend(self.packets)
-            return
-        remaining = length
-        while True:
-            for packet in self.packets:
-                if packet.size > remaining * 2:
-                    return
-                stream.append(packet)
-                remaining -= packet.size
-        print("REM", remaining)
-
-class StretchSound(Sound):
-    def __init__(self, groups: List[List[audio.Packet]]) -> None:
-        self.groups = [group for group in groups if group]
-    def emit(self, stream: audio.Stream, length: Optional[int]) -> None:
-        if not self.groups:
-            return
-        if length is None:
-            for group in self.groups:
-                stream.extend(group)
-            return
-        ngroups = len(self.groups)
-        gpacket: List[List[audio.Packet]] = [[] for _ in range(ngroups)]
-        glength: List[int] = [0 for _ in range(ngroups)]
-        remaining = length
-        while True:
-            minlength = min(glength)
-            idx = -1
-            for idx, glen in enumerate(glength):
-                if glen == minlength:
-                    break
-            assert 0 <= idx < ngroups
-            group = self.groups[idx]
-            packets = gpacket[idx]
-            packet = group[len(packets) % len(group)]
-            if packet.size > remaining * 2:
-                break
-            packets.append(packet)
-            remaining -= packet.size
-            glength[idx] += packet.size
-        for group in gpacket:
-            stream.extend(group)
-
-class StretchPitchSound(Sound):
-    def __init__(self, groups: List[List[audio.Packet]]) -> None:
-        self.groups = [group for group in groups if group]
-        self.lengths = [sum(packet.size for packet in group)
-                        for group in groups]
-    def emit(self, stream: audio.Stream, length: Optional[int]) -> None:
-        if not self.groups:
-            return
-        if length is None:
-            for group in self.groups:
-                stream.extend(group)
-            return
-        ngroups = len(self.groups)
-        glength = [0 for _ in range(ngroups)]
-        gcount = [0 for _ in range(ngroups)]
-        remaining = length
-        while True:
-            minlength = min(glength)
-            idx = -1
-            for idx, glen in enumerate(glength):
-                if glen == minlength:
-                    break
-            assert 0 <= idx < ngroups
-            length = self.lengths[idx]
-            if length > remaining * 2:
-                break
-            glength[idx] += length
-            gcount[idx] += 1
-            remaining -= length
-        for count, group in zip(gcount, self.groups):
-            for i in range(count):
-                stream.extend(group)
+################################################################################
+# Parsing
+################################################################################
+
+def parse_input(args: List[str]) -> str:
+    try:
+        path, = args
+    except ValueError:
+        raise ScriptError("Invalid input command")
+    return path
+
+def parse_word(args: List[str]) -> str:
+    try:
+        name, = args
+    except ValueError:
+        raise ScriptError("Invalid word command")
+    return name
+
+def parse_output(args: List[str]) -> Tuple[str, bool]:
+    """Parse an output command.
+
+    Returns:
+      A tuple (path, reorder), where reorder is true if the clips may be
+      reordered.
+    """
+    try:
+        path, *flags = args
+    except ValueError:
+        raise ScriptError("Invalid output command")
+    if flags not in ([], ["reorder"]):
+        raise ScriptError("Invalid output command")
+    return path, bool(flags)
+
+def parse_clip(args: List[str]) -> str:
+    try:
+        name, = args
+    except ValueError:
+        raise ScriptError("Invalid clip command")
+    return name
+
+def parse_sound(args: List[str]) -> Tuple[str, int, int, str, List[str]]:
+    """Parse a sound in an input group.
+
+    Returns:
+      A tuple (name, start, length, method, params), with the start and length
+      in samples.
+    """
+    try:
+        name, sstart, slength, method, *params = args
+        start = round(float(sstart) * 48)
+        length = round(float(slength) * 48)
+    except ValueError:
+        raise ScriptError("Invalid sound")
+    return name, start, length, method, params
+
+def check_no_params(args: List[str]) -> None:
+    if args:
+        raise ScriptError("Unexpected sound parameter")
+
+def parse_segments(args: List[str], length: int) -> List[int]:
+    """Parse the segment sizes of a pitched sound, in samples."""
+    try:
+        ssizes, = args
+    except ValueError:
+        raise ScriptError("Expected one sound parameter")
+    sizes: List[int] = []
+    for ssize in ssizes.split(","):
+        i = ssize.find('x')
+        try:
+            if i == -1:
+                n = 1
+                v = int(ssize)
+            else:
+                n = int(ssize[:i])
+                v = int(ssize[i+1:])
+        except ValueError:
+            raise ScriptError("Invalid segment size {!r}".format(ssize))
+        if n <= 0 or v <= 0:
+            raise ScriptError("Invalid segment size {!r}".format(ssize))
+        v *= 48
+        sizes.extend(v for _ in range(n))
+    if sum(sizes) > length:
+        raise ScriptError("Segments are larger than enclosing clip")
+    return sizes
+
+def parse_use(args: List[str]) -> Tuple[str, Optional[int]]:
+    """Parse a use of a sound in a word or clip.
+
+    Returns:
+      A tuple (name, length), with the length in samples, or None if the
+      sound's natural length is used.
+    """
+    if not (1 <= len(args) <= 2):
+        raise ScriptError("Expected 1 or 2 arguments")
+    name = args[0]
+    length: Optional[int] = None
+    if len(args) == 2 and args[1] != "-":
+        try:
+            length = int(args[1])
+        except ValueError:
+            raise ScriptError("Invalid length")
+        length *= 48
+    return name, length
+
+def plan_packets(start: int, length: int, params: List[str]) -> List[int]:
+    """Plan a sound made from one series of packets."""
+    check_no_params(params)
+    return list(packetize(length))
+
+def plan_segments(start: int, length: int,
+                  params: List[str]) -> List[List[Any]]:
+    """Plan a pitched sound made from several segments.
+
+    Returns:
+      A list of [pos, sizes] for each segment, with the position of the
+      segment in the input and the length of each packet in the segment.
+    """
+    sizes = parse_segments(params, length)
+    pgroups = [list(packetize(size)) for size in sizes]
+    extra = sum(length for pgroup in pgroups for length in pgroup)
+    pos = 0
+    plan: List[List[Any]] = []
+    for n, pgroup in enumerate(pgroups):
+        plan.append(
+            [start + pos + (n+1)*extra//(len(pgroups)+1), pgroup])
+        pos += sum(pgroup)
+    return plan
+
+def plan_shift(start: int, length: int, params: List[str]) -> int:
+    """Plan a sound whose packets are chosen from the audio.
+
+    The packets are chosen when the script runs, since that needs the audio.
+    The one optional parameter is the largest distance, in ms, that the start
+    of the sound may move.
+
+    Returns:
+      The largest distance to move the start, in samples.
+    """
+    if not params:
+        return 0
+    try:
+        sshift, = params
+    except ValueError:
+        raise ScriptError("Expected at most one sound parameter")
+    try:
+        shift = round(float(sshift) * 48)
+    except ValueError:
+        raise ScriptError("Invalid shift {!r}".format(sshift))
+    if shift < 0:
+        raise ScriptError("Invalid shift {!r}".format(sshift))
+    return shift
+
+# Functions which plan the packet layout of sounds, by method.
+PLANNERS: Dict[str, Callable[[int, int, List[str]], Any]] = {
+    "once": plan_packets,
+    "looped": plan_packets,
+    "pitched": plan_segments,
+    "optimal": plan_shift,
+}
+
+# Commands allowed in each kind of group. The "." command adds or uses a
+# sound.
+COMMANDS: Dict[str, Set[str]] = {
+    "State": {"input", "word", "output"},
+    "InputGroup": {".", "end"},
+    "WordGroup": {".", "end"},
+    "OutputGroup": {"clip", "end"},
+    "StreamGroup": {".", "end"},
+}
+
+class Program:
+    """A script compiled to a list of operations.
+
+    Compiled scripts have been checked for every error that does not depend on
+    the contents of input files, and have their sound layouts already
+    computed, so they can be run without parsing.
+
+    Attributes:
+      ops: Operations to run, in order. Each operation is a list containing
+        the line number, the name of the operation, and its arguments.
+    """
+    ops: List[List[Any]]
+
+    def __init__(self, ops: List[List[Any]]) -> None:
+        self.ops = ops
+
+    def input_paths(self) -> List[str]:
+        """Return the paths of the input files, relative to the script."""
+        return [op[2] for op in self.ops if op[1] == "input"]
+
+def compile_script(lines: Iterable[str]) -> Program:
+    """Compile a script, checking it for errors.
+
+    This checks commands and their arguments, and that sounds are defined
+    before they are used. Errors which depend on the audio data, such as sounds
+    which extend past the end of an input file, are not detected. This does
+    not load NumPy or SciPy.
+    """
+    ops: List[List[Any]] = []
+    groups: List[str] = []
+    # Map from sound name to True if defined, False if it is a word being
+    # defined.
+    sounds: Dict[str, bool] = {}
+    clips: Set[str] = set()
+    word = ""
+    lineno = 0
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        cmd_name, *args = line.split()
+        group = groups[-1] if groups else "State"
+        if cmd_name not in COMMANDS[group]:
+            raise ScriptError("Unknown command {!r}".format(cmd_name),
+                              lineno=lineno)
+        try:
+            if cmd_name == "end":
+                if args:
+                    raise ScriptError("Unexpected argument")
+                if groups.pop() == "WordGroup":
+                    sounds[word] = True
+                ops.append([lineno, "end"])
+            elif cmd_name == "input":
+                ops.append([lineno, "input", parse_input(args)])
+                groups.append("InputGroup")
+            elif cmd_name == "word":
+                word = parse_word(args)
+                if word in sounds:
+                    raise ScriptError("Duplicate sound name {!r}"
+                                      .format(word))
+                sounds[word] = False
+                ops.append([lineno, "word", word])
+                groups.append("WordGroup")
+            elif cmd_name == "output":
+                ops.append([lineno, "output", *parse_output(args)])
+                clips.clear()
+                groups.append("OutputGroup")
+            elif cmd_name == "clip":
+                name = parse_clip(args)
+                if name in clips:
+                    raise ScriptError("Duplicate clip name {!r}".format(name))
+                clips.add(name)
+                ops.append([lineno, "clip", name])
+                groups.append("StreamGroup")
+            elif group == "InputGroup":
+                name, start, length, method, params = parse_sound(args)
+                if name in sounds:
+                    raise ScriptError("Duplicate sound {!r}".format(name))
+                planner = PLANNERS.get(method)
+                if planner is None:
+                    raise ScriptError("Unknown method {!r}".format(method))
+                plan = planner(start, length, params)
+                sounds[name] = True
+                ops.append([lineno, "sound", name, start, length, method,
+                            params, plan])
+            else:
+                name, slength = parse_use(args)
+                defined = sounds.get(name)
+                if defined is None:
+                    raise ScriptError("Undefined sound {!r}".format(name))
+                if not defined:
+                    raise ScriptError("Cannot recursively use sound {!r}"
+                                      .format(name))
+                ops.append([lineno, "use", name, slength])
+        except ScriptError as ex:
+            ex.lineno = lineno
+            raise
+    if groups:
+        raise ScriptError("Unclosed group: {}".format(groups[-1]),
+                          lineno=lineno)
+    return Program(ops)
+
+def load_program(script: str, *, save: bool = True) -> Program:
+    """Compile a script file, reusing the compiled script if it is unchanged.
+
+    The compiled script is stored next to the script, with ".ir" appended to
+    the name, together with the hash of the script text.
+
+    Arguments:
+      script: Path to the script.
+      save: If false, a newly compiled script is not stored.
+    """
+    with open(script, "rb") as fp:
+        text = fp.read()
+    shash = hashlib.sha256(text).hexdigest()
+    ir_path = script + ".ir"
+    try:
+        with open(ir_path) as fp:
+            obj = json.load(fp)
+    except (OSError, ValueError):
+        obj = None
+    if (isinstance(obj, dict) and obj.get("version") == IR_VERSION and
+            obj.get("hash") == shash):
+        return Program(obj["ops"])
+    program = compile_script(text.decode("UTF-8").splitlines())
+    if not save:
+        return program
+    obj = {
+        "version": IR_VERSION,
+        "hash": shash,
+        "ops": program.ops,
+    }
+    tpath = ir_path + ".tmp"
+    try:
+        with open(tpath, "w") as fp:
+            json.dump(obj, fp, separators=(",", ":"))
+        os.replace(tpath, ir_path)
+    except OSError:
+        pass
+    return program
 
 ################################################################################
 # Main
 ################################################################################
 
-def main() -> None:
-    import sys
+def check_file(script: str) -> None:
+    """Check a script file for errors without running it.
+
+    This also checks that the input files exist. No files are written.
+    """
+    try:
+        program = load_program(script, save=False)
+        base_path = os.path.dirname(script)
+        for lineno, opcode, *args in program.ops:
+            if opcode == "input" and \
+               not os.path.isfile(os.path.join(base_path, args[0])):
+                raise ScriptError("Input file not found: {!r}"
+                                  .format(args[0]), lineno=lineno)
+    except ScriptError as ex:
+        print("Error: {}:{}: {}".format(script, ex.lineno, ex),
+              file=sys.stderr)
+        raise
 
-    if len(sys.argv) != 2:
-        print("Error: Need script", file=sys.stderr)
-        raise SystemExit(2)
+def script_paths(script: str) -> List[str]:
+    """Return the paths of the files a script reads.
 
-    script = os.path.abspath(sys.argv[1])
-    state = State(os.path.dirname(script))
+    If the script has errors, only the script itself is returned.
+    """
+    base_path = os.path.dirname(script)
+    try:
+        program = load_program(script)
+    except ScriptError:
+        return [script]
+    return [script] + [os.path.join(base_path, path)
+                       for path in program.input_paths()]
+
+def run_script(script: str, memo: Optional[Memo] = None) -> None:
+    """Run a script, writing its outputs.
+
+    Arguments:
+      script: Absolute path to the script.
+      memo: Results to reuse from previous runs.
+    """
+    base_path = os.path.dirname(script)
+    state = State(base_path, script + ".deps", memo)
     try:
-        with open(script) as fp:
-            state.run(fp)
+        program = load_program(script)
+        state.run(program)
     except ScriptError as ex:
         print("Error: {}:{}: {}".format(script, ex.lineno, ex),
               file=sys.stderr)
+        raise
+
+def watch(script: str,
+          report: Optional[Callable[[timing.Profiler], None]] = None) -> None:
+    """Run a script, and run it again whenever it or its inputs change.
+
+    Decoded inputs, extracted sounds, and encoded packets are kept in memory
+    between runs, and outputs are only written when their dependencies
+    change. Files are watched from the start of each run, so changes made
+    while the script is running cause another run.
+
+    Arguments:
+      script: Absolute path to the script.
+      report: If not None, each run is profiled and this is called with the
+        profiler after the run.
+    """
+    memo = Memo()
+    w = watcher.Watcher()
+    try:
+        while True:
+            t0 = time.perf_counter()
+            w.watch(script_paths(script))
+            if report is not None:
+                profiler = timing.enable()
+            try:
+                run_script(script, memo)
+            except ScriptError:
+                pass
+            except Exception:
+                traceback.print_exc()
+            else:
+                print("Done in {:.2f}s".format(time.perf_counter() - t0),
+                      file=sys.stderr)
+            memo.collect()
+            if report is not None:
+                report(profiler)
+            print("Watching for changes", file=sys.stderr)
+            changed = w.wait()
+            for path in sorted(changed):
+                print("Changed {}".format(path), file=sys.stderr)
+    finally:
+        w.close()
+
+def main() -> None:
+    p = argparse.ArgumentParser(
+        description="Create an Opus file from a script.")
+    p.add_argument("script", help="script to run")
+    p.add_argument("--watch", action="store_true",
+                   help="run the script again whenever its files change")
+    p.add_argument("--check", action="store_true",
+                   help="check the script for errors without running it")
+    p.add_argument("--profile", action="store_true",
+                   help="print a table of where time was spent")
+    p.add_argument("--profile-json", metavar="FILE",
+                   help="write timings of every step to a JSON file")
+    p.add_argument("--trace", metavar="FILE",
+                   help="write timings in Chrome trace event format")
+    args = p.parse_args()
+
+    def report(profiler: timing.Profiler) -> None:
+        if args.profile:
+            profiler.print_summary()
+        if args.profile_json:
+            profiler.write_json(args.profile_json)
+        if args.trace:
+            profiler.write_trace(args.trace)
+
+    profile = bool(args.profile or args.profile_json or args.trace)
+    script = os.path.abspath(args.script)
+    if args.check:
+        try:
+            check_file(script)
+        except ScriptError:
+            raise SystemExit(1)
+        return
+    if args.watch:
+        try:
+            watch(script, report if profile else None)
+        except KeyboardInterrupt:
+            pass
+        return
+    if profile:
+        profiler = timing.enable()
+    try:
+        run_script(script)
+    except ScriptError:
         raise SystemExit(1)
+    finally:
+        if profile:
+            report(profiler)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,164 @@
+import bisect
+import heapq
+import itertools
+
+import numpy
+
+from . import audio
+
+from abc import ABCMeta, abstractmethod
+from typing import List, Optional
+
+class Sound(metaclass=ABCMeta):
+    """Abstract base class for sounds which can be reused to make new sounds."""
+    @abstractmethod
+    def emit(self, stream: audio.Stream, length: Optional[int]) -> None: pass
+    @abstractmethod
+    def packet_arrays(self) -> List[numpy.ndarray]:
+        """Return the arrays of packet indexes that the sound emits."""
+    @abstractmethod
+    def remap(self, mapping: numpy.ndarray) -> None:
+        """Replace each packet index with mapping[index]."""
+
+class OnceSound(Sound):
+    def __init__(self, packets: numpy.ndarray) -> None:
+        self.packets = packets
+    def emit(self, stream: audio.Stream, length: Optional[int]) -> None:
+        stream.extend(self.packets)
+    def packet_arrays(self) -> List[numpy.ndarray]:
+        return [self.packets]
+    def remap(self, mapping: numpy.ndarray) -> None:
+        self.packets = mapping[self.packets]
+
+class LoopedSound(Sound):
+    def __init__(self, packets: numpy.ndarray) -> None:
+        self.packets = packets
+        self.sizes = audio.PACKETS.size[packets].tolist()
+    def emit(self, stream: audio.Stream, length: Optional[int]) -> None:
+        if not len(self.packets):
+            print("NO")
+            return
+        if length is None:
+            stream.extend(self.packets)
+            return
+        remaining = length
+        count = 0
+        while True:
+            size = self.sizes[count % len(self.sizes)]
+            if size > remaining * 2:
+                break
+            count += 1
+            remaining -= size
+        stream.extend(self.packets[numpy.arange(count) % len(self.packets)])
+    def packet_arrays(self) -> List[numpy.ndarray]:
+        return [self.packets]
+    def remap(self, mapping: numpy.ndarray) -> None:
+        self.packets = mapping[self.packets]
+
+def stretch_counts(sizes: List[List[int]], length: int) -> List[int]:
+    """Return the number of packets to emit from each group of a sound which
+    is stretched to a given length.
+
+    Packets are added one at a time to the group with the shortest total
+    length so far, choosing the first such group on ties, and each group
+    cycles through its packet sizes. This stops at the first packet which is
+    longer than twice the remaining length.
+
+    Rather than adding packets one at a time, this finds the latest point
+    where every packet so far must fit, by binary search, and only adds the
+    last few packets one at a time.
+
+    Arguments:
+      sizes: The size of each packet in each group, which must be positive.
+      length: The length to fill, in samples.
+    """
+    ngroups = len(sizes)
+    prefixes = [[0] + list(itertools.accumulate(gsizes))
+                for gsizes in sizes]
+
+    def count_before(i: int, t: int) -> int:
+        """Return the number of packets group i adds before its length
+        reaches t."""
+        prefix = prefixes[i]
+        n = len(prefix) - 1
+        cycles, rem = divmod(t, prefix[n])
+        return cycles * n + bisect.bisect_left(prefix, rem, 0, n)
+
+    def length_of(i: int, count: int) -> int:
+        prefix = prefixes[i]
+        n = len(prefix) - 1
+        cycles, rem = divmod(count, n)
+        return cycles * prefix[n] + prefix[rem]
+
+    def total_before(t: int) -> int:
+        return sum(length_of(i, count_before(i, t)) for i in range(ngroups))
+
+    # Every packet which starts before a point t fits if the packets which
+    # start before t add up to no more than the length. Each group's packets
+    # which start before t add up to at least t, so t is at most the length
+    # divided by the number of groups.
+    lo = 0
+    if length > 0:
+        hi = length // ngroups
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if total_before(mid) <= length:
+                lo = mid
+            else:
+                hi = mid - 1
+    counts = [count_before(i, lo) for i in range(ngroups)]
+    heap = [(length_of(i, count), i) for i, count in enumerate(counts)]
+    remaining = length - sum(glength for glength, i in heap)
+    heapq.heapify(heap)
+    while True:
+        glength, i = heap[0]
+        gsizes = sizes[i]
+        size = gsizes[counts[i] % len(gsizes)]
+        if size > remaining * 2:
+            break
+        counts[i] += 1
+        remaining -= size
+        heapq.heapreplace(heap, (glength + size, i))
+    return counts
+
+class StretchSound(Sound):
+    def __init__(self, groups: List[numpy.ndarray]) -> None:
+        self.groups = [group for group in groups if len(group)]
+        self.sizes = [audio.PACKETS.size[group].tolist()
+                      for group in self.groups]
+    def emit(self, stream: audio.Stream, length: Optional[int]) -> None:
+        if not self.groups:
+            return
+        if length is None:
+            for group in self.groups:
+                stream.extend(group)
+            return
+        counts = stretch_counts(self.sizes, length)
+        stream.extend(numpy.concatenate(
+            [group[numpy.arange(count) % len(group)]
+             for count, group in zip(counts, self.groups)]))
+    def packet_arrays(self) -> List[numpy.ndarray]:
+        return self.groups
+    def remap(self, mapping: numpy.ndarray) -> None:
+        self.groups = [mapping[group] for group in self.groups]
+
+class StretchPitchSound(Sound):
+    def __init__(self, groups: List[numpy.ndarray]) -> None:
+        self.groups = [group for group in groups if len(group)]
+        self.lengths = [int(audio.PACKETS.size[group].sum())
+                        for group in self.groups]
+    def emit(self, stream: audio.Stream, length: Optional[int]) -> None:
+        if not self.groups:
+            return
+        if length is None:
+            for group in self.groups:
+                stream.extend(group)
+            return
+        counts = stretch_counts([[glen] for glen in self.lengths], length)
+        stream.extend(numpy.concatenate(
+            [numpy.tile(group, count)
+             for count, group in zip(counts, self.groups)]))
+    def packet_arrays(self) -> List[numpy.ndarray]:
+        return self.groups
+    def remap(self, mapping: numpy.ndarray) -> None:
+        self.groups = [mapping[group] for group in self.groups]
@@ -0,0 +1,177 @@
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+from typing import Any, Dict, IO, Iterator, List, Optional, Tuple
+
+class Span:
+    """A timed section of work.
+
+    Attributes:
+      name: Name of the work, such as a command or function name.
+      category: Phase the work belongs to, such as "input" or "encode".
+      start: Start time, in seconds, from time.perf_counter.
+      end: End time, in seconds.
+      thread: Identifier of the thread which did the work.
+      args: Extra information about the work, such as byte or packet counts.
+        Numeric values are summed in the summary.
+    """
+    name: str
+    category: str
+    start: float
+    end: float
+    thread: int
+    args: Dict[str, Any]
+
+    def __init__(self, name: str, category: str, args: Dict[str, Any]) -> None:
+        self.name = name
+        self.category = category
+        self.start = time.perf_counter()
+        self.end = self.start
+        self.thread = threading.get_ident()
+        self.args = args
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+class Profiler:
+    """A record of timed spans of work.
+
+    Attributes:
+      start: Time the profiler was created, in seconds.
+      spans: Finished spans, in the order they finished.
+    """
+    start: float
+    spans: List[Span]
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.spans = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str,
+             **args: Any) -> Iterator[Dict[str, Any]]:
+        s = Span(name, category, args)
+        try:
+            yield args
+        finally:
+            s.end = time.perf_counter()
+            with self.lock:
+                self.spans.append(s)
+
+    def summary(self) -> List[Dict[str, Any]]:
+        """Return the total time and counters for each kind of span.
+
+        Nested spans are each counted in full, so the totals of nested
+        categories add up to more than the wall time.
+        """
+        groups: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        for s in self.spans:
+            key = s.category, s.name
+            group = groups.get(key)
+            if group is None:
+                group = {
+                    "category": s.category,
+                    "name": s.name,
+                    "count": 0,
+                    "time": 0.0,
+                    "max": 0.0,
+                    "counters": {},
+                }
+                groups[key] = group
+            group["count"] += 1
+            group["time"] += s.duration
+            group["max"] = max(group["max"], s.duration)
+            counters = group["counters"]
+            for name, value in s.args.items():
+                if isinstance(value, (int, float)) and \
+                   not isinstance(value, bool):
+                    counters[name] = counters.get(name, 0) + value
+        return sorted(groups.values(), key=lambda g: -g["time"])
+
+    def print_summary(self, fp: IO[str] = sys.stderr) -> None:
+        """Print a table of where time was spent."""
+        total = time.perf_counter() - self.start
+        print("    Time (s)  Count  Max (s)  Category    Name", file=fp)
+        for group in self.summary():
+            counters = "".join(
+                "  {}={}".format(name, value)
+                for name, value in sorted(group["counters"].items()))
+            print("    {:8.3f}  {:5}  {:7.3f}  {:10}  {}{}".format(
+                group["time"], group["count"], group["max"],
+                group["category"], group["name"], counters), file=fp)
+        print("    {:8.3f}  Total wall time".format(total), file=fp)
+
+    def write_json(self, path: str) -> None:
+        """Write the summary and every span as JSON."""
+        obj = {
+            "time": time.perf_counter() - self.start,
+            "summary": self.summary(),
+            "spans": [{
+                "name": s.name,
+                "category": s.category,
+                "start": s.start - self.start,
+                "duration": s.duration,
+                "thread": s.thread,
+                "args": s.args,
+            } for s in self.spans],
+        }
+        with open(path, "w") as fp:
+            json.dump(obj, fp, indent=True, sort_keys=True, default=str)
+
+    def write_trace(self, path: str) -> None:
+        """Write the spans in Chrome trace event format.
+
+        The file can be loaded in chrome://tracing or Perfetto.
+        """
+        threads: Dict[int, int] = {}
+        events = []
+        for s in sorted(self.spans, key=lambda s: s.start):
+            tid = threads.setdefault(s.thread, len(threads) + 1)
+            events.append({
+                "name": s.name,
+                "cat": s.category,
+                "ph": "X",
+                "ts": (s.start - self.start) * 1e6,
+                "dur": s.duration * 1e6,
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": s.args,
+            })
+        with open(path, "w") as fp:
+            json.dump({"traceEvents": events}, fp, default=str)
+
+# The active profiler, or None if profiling is off.
+PROFILER: Optional[Profiler] = None
+
+@contextlib.contextmanager
+def null_span() -> Iterator[Dict[str, Any]]:
+    yield {}
+
+def span(name: str, category: str,
+         **args: Any) -> "contextlib.AbstractContextManager[Dict[str, Any]]":
+    """Time a section of work, if profiling is on.
+
+    This returns a context manager which yields a dictionary. Values added to
+    the dictionary are recorded with the span.
+
+    Arguments:
+      name: Name of the work.
+      category: Phase the work belongs to.
+      args: Extra information about the work.
+    """
+    profiler = PROFILER
+    if profiler is None:
+        return null_span()
+    return profiler.span(name, category, **args)
+
+def enable() -> Profiler:
+    """Turn on profiling and return the profiler."""
+    global PROFILER
+    PROFILER = Profiler()
+    return PROFILER
@@ -0,0 +1,203 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+# Constants from sys/inotify.h.
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+IN_Q_OVERFLOW = 0x00004000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE)
+
+EVENT = struct.Struct("iIII")
+
+# Time to wait after a change for more changes, in seconds. Editors often
+# write a file in several steps.
+SETTLE_TIME = 0.05
+
+# Time between checks when polling, in seconds.
+POLL_INTERVAL = 0.2
+
+def load_libc() -> Optional[ctypes.CDLL]:
+    """Load the C library, returning None if it does not support inotify."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_init1.restype = ctypes.c_int
+        libc.inotify_add_watch.argtypes = [
+            ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_add_watch.restype = ctypes.c_int
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        libc.inotify_rm_watch.restype = ctypes.c_int
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+def stat(path: str) -> Optional[Tuple[int, int]]:
+    """Return the modification time and size of a file, or None."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+class Watcher:
+    """Waits for changes to files.
+
+    This uses inotify where it is available, and otherwise polls the
+    modification time of each file. With inotify, the directories containing
+    the files are watched rather than the files themselves, so files which are
+    replaced by renaming a new copy over them are still noticed.
+
+    Attributes:
+      paths: Absolute paths of the watched files.
+      polling: True if the files are polled instead of watched with inotify.
+      initial: When polling, the modification time and size of each file when
+        it started being watched.
+    """
+    fd: Optional[int]
+    dirs: Dict[str, int]
+    wds: Dict[int, str]
+    paths: Set[str]
+    polling: bool
+    initial: Dict[str, Optional[Tuple[int, int]]]
+
+    def __init__(self) -> None:
+        self.fd = None
+        self.dirs = {}
+        self.wds = {}
+        self.paths = set()
+        self.polling = True
+        self.initial = {}
+        self.libc = load_libc()
+        if self.libc is not None:
+            fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                self.fd = fd
+
+    def close(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def watch(self, paths: Iterable[str]) -> None:
+        """Start watching the given files, replacing the previous set.
+
+        Changes made after this returns are reported by the next call to
+        wait(), even if they are made before wait() is called.
+        """
+        self.paths = {os.path.abspath(path) for path in paths}
+        self.polling = not (self.fd is not None and self.set_dirs(self.paths))
+        if self.polling:
+            self.initial = {path: stat(path) for path in self.paths}
+        else:
+            # Discard events from before the files started being watched.
+            while True:
+                changed, overflow = self.read_events(self.paths, 0)
+                if not changed and not overflow:
+                    break
+
+    def wait(self) -> Set[str]:
+        """Wait until any of the watched files changes.
+
+        Returns:
+          The set of paths which changed.
+        """
+        if self.polling:
+            return self.wait_poll(self.paths)
+        return self.wait_inotify(self.paths)
+
+    def set_dirs(self, paths: Set[str]) -> bool:
+        """Watch the directories containing the given paths.
+
+        Returns:
+          False if any directory could not be watched.
+        """
+        assert self.fd is not None and self.libc is not None
+        dirs = {os.path.dirname(path) for path in paths}
+        for path in list(self.dirs):
+            if path not in dirs:
+                wd = self.dirs.pop(path)
+                del self.wds[wd]
+                self.libc.inotify_rm_watch(self.fd, wd)
+        for path in dirs:
+            if path in self.dirs:
+                continue
+            wd = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(path), WATCH_MASK)
+            if wd < 0:
+                return False
+            self.dirs[path] = wd
+            self.wds[wd] = path
+        return True
+
+    def read_events(self, paths: Set[str],
+                    timeout: Optional[float]) -> Tuple[Set[str], bool]:
+        """Read pending inotify events.
+
+        Returns:
+          A tuple (changed, overflow), where changed is the set of watched
+          paths with events, and overflow is true if events were lost.
+        """
+        assert self.fd is not None
+        changed: Set[str] = set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return changed, False
+        try:
+            buf = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return changed, False
+        pos = 0
+        overflow = False
+        while pos < len(buf):
+            wd, mask, _, namelen = EVENT.unpack_from(buf, pos)
+            pos += EVENT.size
+            name = buf[pos:pos+namelen].rstrip(b"\0")
+            pos += namelen
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            dirpath = self.wds.get(wd)
+            if dirpath is None:
+                continue
+            path = os.path.join(dirpath, os.fsdecode(name))
+            if path in paths:
+                changed.add(path)
+        return changed, overflow
+
+    def wait_inotify(self, paths: Set[str]) -> Set[str]:
+        changed: Set[str] = set()
+        while not changed:
+            changed, overflow = self.read_events(paths, None)
+            if overflow:
+                return set(paths)
+        while True:
+            more, overflow = self.read_events(paths, SETTLE_TIME)
+            if overflow:
+                return set(paths)
+            if not more:
+                return changed
+            changed.update(more)
+
+    def wait_poll(self, paths: Set[str]) -> Set[str]:
+        while True:
+            time.sleep(POLL_INTERVAL)
+            changed = {path for path in paths
+                       if stat(path) != self.initial[path]}
+            if changed:
+                time.sleep(SETTLE_TIME)
+                return changed
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Tests import opuscraft from the source tree.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
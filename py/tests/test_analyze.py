@@ -0,0 +1,36 @@
+import numpy
+
+from opuscraft import analyze
+
+def direct_period(data: numpy.ndarray, pos: int) -> int:
+    # The autocorrelation that get_period is defined by, computed directly
+    # for each lag.
+    tmax = analyze.PERIOD_MAX
+    x = data.astype(numpy.float64)
+    windowed = x[pos-tmax*2:pos+tmax*2] * analyze.blackman_window(tmax * 4)
+    corr = [numpy.dot(windowed, x[pos-tmax*2+lag:pos+tmax*2+lag] +
+                      x[pos-tmax*2-lag:pos+tmax*2-lag])
+            for lag in range(analyze.PERIOD_MIN, analyze.PERIOD_MAX)]
+    return int(numpy.argmax(corr)) + analyze.PERIOD_MIN
+
+def test_get_periods() -> None:
+    # A tone with harmonics and noise, whose period changes every 0.25 s.
+    rs = numpy.random.RandomState(1)
+    periods = [400.0, 455.5, 520.25, 580.0, 371.0]
+    phase = numpy.concatenate(
+        [numpy.full(12000, 2 * numpy.pi / period) for period in periods])
+    phase = numpy.cumsum(phase)
+    data = (numpy.sin(phase) + 0.5 * numpy.sin(2 * phase) +
+            0.25 * numpy.sin(3 * phase) + 0.1 * rs.randn(len(phase)))
+    data = data.astype(numpy.float32)
+    # More positions than PERIOD_CHUNK, so several chunks are used.
+    positions = list(range(1900, len(data) - 1900, 397))
+    assert len(positions) > analyze.PERIOD_CHUNK
+    expected = [direct_period(data, pos) for pos in positions]
+    assert analyze.get_periods(data, positions).tolist() == expected
+    assert [analyze.get_period(data, pos) for pos in positions[:5]] == \
+        expected[:5]
+    # Positions in the middle of each tone find its period.
+    for n, period in enumerate(periods):
+        pos = n * 12000 + 6000
+        assert abs(analyze.get_period(data, pos) - period) <= 1
@@ -0,0 +1,72 @@
+import os
+
+import numpy
+
+from opuscraft import audio
+
+def test_opustool_script_resets() -> None:
+    # Opustool must reset the encoder at the same packets as encode_packets,
+    # so both backends produce the same packets.
+    table = audio.PacketTable()
+    data = numpy.zeros(4800, numpy.float32)
+    first = table.add_audio(data, [960, 960]).tolist()
+    second = table.add_audio(data, [960]).tolist()
+    scripts = [table.script(idx) for idx in first + second]
+    assert [script.startswith("reset\n") for script in scripts] == \
+        [True, False, True]
+    assert all("independent\n" in script for script in
+               (scripts[0], scripts[2]))
+
+def test_intern_ignores_other_streams() -> None:
+    # Interning a stream must not depend on which streams were interned
+    # before it, or outputs would change with the order they are written in.
+    table = audio.PacketTable()
+    data = numpy.ones(960, numpy.float32)
+    a = table.add_audio(data, [960])
+    b = table.add_audio(data, [960])
+    c = table.add_audio(data, [960])
+    assert table.intern(numpy.concatenate([a, c])).tolist() == [a[0], a[0]]
+    assert table.intern(numpy.concatenate([c, b])).tolist() == [b[0], b[0]]
+
+def test_add_audio_shares_source() -> None:
+    table = audio.PacketTable()
+    data = numpy.arange(9600, dtype=numpy.float32)
+    first = table.add_audio(data, [960])
+    second = table.add_audio(data[1000:3000], [960, 960])
+    third = table.add_audio(data, [480])
+    assert len(table.sources) == 1
+    assert table.data(first[0])[0] == 0
+    assert table.data(second[0])[0] == 1000
+    assert table.data(second[1])[0] == 1960
+    assert table.data(third[0])[0] == 0
+
+def test_compact() -> None:
+    table = audio.PacketTable()
+    first = numpy.arange(9600, dtype=numpy.float32)
+    second = numpy.ones(960, numpy.float32)
+    a = table.add_audio(first, [960, 960])
+    b = table.add_audio(second, [960])
+    mapping = table.compact(numpy.concatenate([a[1:], b]))
+    assert mapping.tolist() == [-1, 0, 1]
+    assert table.count == 2 and len(table.sources) == 2
+    assert table.data(0)[0] == 960
+    mapping = table.compact(numpy.array([1], numpy.int32))
+    assert table.count == 1 and len(table.sources) == 1
+    assert table.data(0)[0] == 1
+
+def test_load_audio_retries_after_eviction(monkeypatch, tmp_path) -> None:
+    monkeypatch.setenv("OPUSCRAFT_CACHE", str(tmp_path / "cache"))
+    path = tmp_path / "input.wav"
+    path.write_bytes(b"input")
+    decoded = numpy.arange(10, dtype=numpy.float32)
+    monkeypatch.setattr(audio, "decode_audio",
+                        lambda path, out_path: decoded.tofile(out_path))
+    map_audio = audio.map_audio
+
+    def evict_then_map(cpath):
+        # Remove the entry before it is mapped, as another thread can.
+        monkeypatch.setattr(audio, "map_audio", map_audio)
+        os.remove(cpath)
+        return map_audio(cpath)
+    monkeypatch.setattr(audio, "map_audio", evict_then_map)
+    assert audio.load_audio(str(path)).tolist() == decoded.tolist()
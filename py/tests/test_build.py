@@ -0,0 +1,75 @@
+import struct
+
+import pytest
+
+import build
+
+def make_files(monkeypatch, tmp_path) -> build.FileSet:
+    monkeypatch.setenv("OPUSCRAFT_CACHE", str(tmp_path / "cache"))
+    files = build.FileSet(tmp_path / "test.zip", tmp_path, release=False)
+    files.add("index.html", b"<!doctype html>" * 100)
+    files.add("data.bin", bytes(range(256)) * 10)
+    files.finish()
+    return files
+
+def corrupt(files: build.FileSet, buffer: str, offset: int) -> None:
+    """Flip the low bit of a 32-bit field in one of the archive buffers."""
+    view = getattr(files, buffer).getbuffer()
+    value, = struct.unpack_from("<I", view, offset)
+    struct.pack_into("<I", view, offset, value ^ 1)
+    del view
+
+def test_check(monkeypatch, tmp_path) -> None:
+    make_files(monkeypatch, tmp_path).check()
+
+# Offsets of fields for the first file, in its central directory entry and
+# its local header.
+DIRECTORY_CRC = 16
+DIRECTORY_SIZE = 24
+LOCAL_CRC = 14
+LOCAL_SIZE = 22
+
+@pytest.mark.parametrize("buffer,offset,message", [
+    ("directory", DIRECTORY_CRC, "local header mismatch"),
+    ("directory", DIRECTORY_SIZE, "local header mismatch"),
+    ("body", LOCAL_CRC, "local header mismatch"),
+    ("body", LOCAL_SIZE, "local header mismatch"),
+])
+def test_check_corrupt_header(monkeypatch, tmp_path,
+                              buffer, offset, message) -> None:
+    files = make_files(monkeypatch, tmp_path)
+    corrupt(files, buffer, offset)
+    with pytest.raises(ValueError, match=message):
+        files.check()
+
+@pytest.mark.parametrize("directory_offset,local_offset", [
+    (DIRECTORY_CRC, LOCAL_CRC),
+    (DIRECTORY_SIZE, LOCAL_SIZE),
+])
+def test_check_corrupt_data(monkeypatch, tmp_path,
+                            directory_offset, local_offset) -> None:
+    # Change the field in both headers, so only the check of the inflated
+    # data can catch it.
+    files = make_files(monkeypatch, tmp_path)
+    corrupt(files, "directory", directory_offset)
+    corrupt(files, "body", local_offset)
+    with pytest.raises(ValueError, match="size or CRC mismatch"):
+        files.check()
+
+def test_tune_zopfli_installed(monkeypatch, tmp_path) -> None:
+    # A record made without zopfli must not be reused once it is installed.
+    monkeypatch.setenv("OPUSCRAFT_CACHE", str(tmp_path / "cache"))
+    fpath = tmp_path / "data"
+    data = b"test data " * 100
+    fpath.write_bytes(data)
+    monkeypatch.setattr(build.shutil, "which", lambda name: None)
+    cdata, trials = build.tune(fpath, data, 1)
+    assert [trial.setting for trial in trials] == ["zlib-9"]
+
+    def deflate(fpath, data, setting):
+        obj = build.zlib.compressobj(9, build.zlib.DEFLATED, -15, 9)
+        return obj.compress(data) + obj.flush()
+    monkeypatch.setattr(build.shutil, "which", lambda name: "/bin/" + name)
+    monkeypatch.setattr(build, "deflate", deflate)
+    cdata, trials = build.tune(fpath, data, 1)
+    assert "zopfli-i15" in [trial.setting for trial in trials]
@@ -0,0 +1,29 @@
+import sqlite3
+
+from opuscraft import cache
+
+def test_packet_cache_evicts_least_recently_used(tmp_path) -> None:
+    path = str(tmp_path / "packets.sqlite")
+    pcache = cache.PacketCache(path, 250)
+    pcache.put_many([(b"a", b"x" * 100), (b"b", b"x" * 100)])
+    # Using a refreshes it, so b is evicted when c is added.
+    assert pcache.get_many([b"a"]) == {b"a": b"x" * 100}
+    pcache.put_many([(b"c", b"x" * 100)])
+    assert set(pcache.get_many([b"a", b"b", b"c"])) == {b"a", b"c"}
+    pcache.close()
+
+def test_packet_cache_version(tmp_path) -> None:
+    path = str(tmp_path / "packets.sqlite")
+    db = sqlite3.connect(path)
+    with db:
+        db.execute("CREATE TABLE packet (key BLOB PRIMARY KEY, "
+                   "data BLOB NOT NULL)")
+        db.execute("INSERT INTO packet VALUES (?, ?)", (b"a", b"old"))
+    db.close()
+    pcache = cache.PacketCache(path, 1 << 20)
+    assert pcache.get_many([b"a"]) == {}
+    pcache.put_many([(b"a", b"new")])
+    pcache.close()
+    pcache = cache.PacketCache(path, 1 << 20)
+    assert pcache.get_many([b"a"]) == {b"a": b"new"}
+    pcache.close()
@@ -0,0 +1,31 @@
+import io
+import zlib
+
+import numpy
+
+from opuscraft import estimate
+from opuscraft import opus
+
+def compressed_size(packets, order) -> int:
+    fp = io.BytesIO()
+    opus.write_opus(fp, packets, [960] * len(packets), order)
+    return len(zlib.compress(fp.getvalue(), 9))
+
+def test_estimate_deflate() -> None:
+    # Encoded Opus packets are close to random, so random bytes stand in for
+    # them. The estimate should stay close to zlib for streams with no
+    # repeats, short loops, repeats outside the window, and random repeats.
+    rs = numpy.random.RandomState(1)
+    packets = [rs.bytes(rs.randint(20, 80)) for _ in range(400)]
+    orders = [
+        list(range(400)),
+        list(range(50)) * 8,
+        [i for r in range(0, 400, 10) for _ in range(3)
+         for i in range(r, r + 10)],
+        list(range(400)) * 3,
+        rs.randint(0, 400, 2000).tolist(),
+    ]
+    for order in orders:
+        expected = compressed_size(packets, order)
+        actual = estimate.estimate_deflate(packets, order)
+        assert abs(actual - expected) <= expected * 0.1, (actual, expected)
@@ -0,0 +1,36 @@
+import json
+import os
+import subprocess
+import sys
+
+# Longest time that importing opuscraft.script may take, in seconds. Importing
+# it takes about 50 ms, and NumPy alone takes longer than this.
+IMPORT_BUDGET = 0.3
+
+PROGRAM = """
+import json, sys, time
+start = time.perf_counter()
+import opuscraft.script
+print(json.dumps({
+    "time": time.perf_counter() - start,
+    "modules": sorted(sys.modules),
+}))
+"""
+
+def test_script_import() -> None:
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.dirname(
+        os.path.dirname(os.path.abspath(__file__)))
+    # Take the fastest of a few runs, since the first may have a cold disk
+    # cache.
+    times = []
+    for _ in range(3):
+        proc = subprocess.run(
+            [sys.executable, "-c", PROGRAM],
+            stdout=subprocess.PIPE, check=True, env=env)
+        result = json.loads(proc.stdout.decode("UTF-8"))
+        modules = set(result["modules"])
+        assert "numpy" not in modules
+        assert "scipy" not in modules
+        times.append(result["time"])
+    assert min(times) < IMPORT_BUDGET
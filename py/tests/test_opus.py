@@ -0,0 +1,86 @@
+import io
+import os
+import struct
+
+from opuscraft import opus
+
+from typing import List, Tuple
+
+# An Ogg Opus file written by opustool.
+OPUSTOOL_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__)))),
+    "game/cyber/audio/audio.opus")
+
+def read_pages(data: bytes) -> List[Tuple[int, int, List[bytes]]]:
+    """Parse an Ogg file into pages.
+
+    Returns:
+      A list of (flags, granulepos, packets) for each page, where packets
+      contains the packets that end on the page.
+    """
+    pages = []
+    pos = 0
+    packet = b""
+    while pos < len(data):
+        assert data[pos:pos+4] == b"OggS"
+        flags = data[pos+5]
+        granulepos, = struct.unpack_from("<q", data, pos + 6)
+        nseg = data[pos+26]
+        lacing = data[pos+27:pos+27+nseg]
+        pos += 27 + nseg
+        packets = []
+        for val in lacing:
+            packet += data[pos:pos+val]
+            pos += val
+            if val < 255:
+                packets.append(packet)
+                packet = b""
+        pages.append((flags, granulepos, packets))
+    return pages
+
+def test_matches_opustool() -> None:
+    with open(OPUSTOOL_FILE, "rb") as fp:
+        expected = fp.read()
+    pages = read_pages(expected)
+    assert pages[0][2][0].startswith(b"OpusHead")
+    assert pages[1][2][0].startswith(b"OpusTags")
+    # Granule positions are only visible at the end of each page, so each
+    # page's duration is given to the last packet that ends on it.
+    packets: List[bytes] = []
+    sizes: List[int] = []
+    prev = 0
+    for flags, granulepos, ppackets in pages[2:]:
+        packets.extend(ppackets)
+        sizes.extend(0 for _ in ppackets)
+        sizes[-1] = granulepos - prev
+        prev = granulepos
+    fp = io.BytesIO()
+    opus.write_opus(fp, packets, sizes, list(range(len(packets))))
+    assert fp.getvalue() == expected
+
+def test_long_packets() -> None:
+    packets = [bytes([n]) * (n * 100 + 1) for n in range(8)]
+    sizes = [960] * len(packets)
+    order = [0, 1, 2, 3, 4, 5, 6, 7] * 20
+    fp = io.BytesIO()
+    opus.write_opus(fp, packets, sizes, order)
+    pages = read_pages(fp.getvalue())
+    data = [packet for flags, granulepos, ppackets in pages[2:]
+            for packet in ppackets]
+    assert data == [packets[idx] for idx in order]
+    # Pages are filled to 32 KiB, and only the first page has the beginning
+    # of stream flag and only the last page has the end of stream flag.
+    assert len(pages) > 3
+    assert [flags & 0x06 for flags, granulepos, ppackets in pages] == \
+        [0x02] + [0] * (len(pages) - 2) + [0x04]
+    assert pages[-1][1] == 960 * len(order)
+
+def test_crc() -> None:
+    # The CRC of an Ogg page header with the CRC field set to zero, from an
+    # opustool file.
+    with open(OPUSTOOL_FILE, "rb") as fp:
+        data = fp.read(47)
+    crc, = struct.unpack_from("<I", data, 22)
+    page = data[:22] + b"\0\0\0\0" + data[26:]
+    assert opus.ogg_crc(page) == crc
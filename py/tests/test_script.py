@@ -0,0 +1,55 @@
+import pytest
+
+from opuscraft import script
+
+# Each script has an error, with the line number and message that the
+# original interpreter reported for it.
+ERRORS = [
+    ("foo a.wav\n",
+     1, "Unknown command 'foo'"),
+    ("input a.wav\nclip a\nend\n",
+     2, "Unknown command 'clip'"),
+    ("input a.wav\n. x 0 100 wobble\nend\n",
+     2, "Unknown method 'wobble'"),
+    ("input a.wav\n. x 0 100 once\n. x 100 100 once\nend\n",
+     3, "Duplicate sound 'x'"),
+    ("input a.wav\n. x 0 100 once\nend\nword x\nend\n",
+     4, "Duplicate sound name 'x'"),
+    ("word w\nend\nword w\nend\n",
+     3, "Duplicate sound name 'w'"),
+    ("input a.wav\n. x 0 100 once\nend\n"
+     "output out.opus\nclip a\n. x\nend\nclip a\nend\nend\n",
+     8, "Duplicate clip name 'a'"),
+    ("word w\n. w\nend\n",
+     2, "Cannot recursively use sound 'w'"),
+    ("output out.opus\nclip a\n. y\nend\nend\n",
+     3, "Undefined sound 'y'"),
+    ("input a.wav\n. x 0 100 once\n\n# comment\n",
+     4, "Unclosed group: InputGroup"),
+    ("output out.opus\nclip a\n",
+     2, "Unclosed group: StreamGroup"),
+    ("input a.wav\n. x 0 100 pitched 0x10\nend\n",
+     2, "Invalid segment size '0x10'"),
+    ("input a.wav\n. x 0 100 pitched 2x60\nend\n",
+     2, "Segments are larger than enclosing clip"),
+    ("input a.wav\nend now\n",
+     2, "Unexpected argument"),
+]
+
+@pytest.mark.parametrize("text,lineno,message", ERRORS)
+def test_compile_errors(text, lineno, message) -> None:
+    with pytest.raises(script.ScriptError) as info:
+        script.compile_script(text.splitlines())
+    assert str(info.value) == message
+    assert info.value.lineno == lineno
+
+def test_compile() -> None:
+    text = ("input a.wav\n. x 0 100 once\nend\n"
+            "word w\n. x\nend\n"
+            "output out.opus\nclip a\n. w 50\nend\nend\n")
+    program = script.compile_script(text.splitlines())
+    assert [op[:2] for op in program.ops] == [
+        [1, "input"], [2, "sound"], [3, "end"],
+        [4, "word"], [5, "use"], [6, "end"],
+        [7, "output"], [8, "clip"], [9, "use"], [10, "end"], [11, "end"],
+    ]
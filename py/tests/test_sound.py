@@ -0,0 +1,40 @@
+from typing import List
+
+import numpy
+
+from opuscraft import sound
+
+def greedy_counts(sizes: List[List[int]], length: int) -> List[int]:
+    # The original algorithm, which adds one packet at a time.
+    counts = [0 for _ in sizes]
+    lengths = [0 for _ in sizes]
+    remaining = length
+    while True:
+        idx = lengths.index(min(lengths))
+        gsizes = sizes[idx]
+        size = gsizes[counts[idx] % len(gsizes)]
+        if size > remaining * 2:
+            break
+        counts[idx] += 1
+        remaining -= size
+        lengths[idx] += size
+    return counts
+
+def test_stretch_counts() -> None:
+    rs = numpy.random.RandomState(1)
+    lengths = [120, 240, 480, 960, 1920, 2880]
+    for _ in range(500):
+        ngroups = rs.randint(1, 6)
+        sizes = [[lengths[i] for i in rs.randint(0, len(lengths),
+                                                 rs.randint(1, 5))]
+                 for _ in range(ngroups)]
+        length = int(rs.randint(0, 100000))
+        assert sound.stretch_counts(sizes, length) == \
+            greedy_counts(sizes, length), (sizes, length)
+
+def test_stretch_counts_equal_groups() -> None:
+    # Ties between groups are common when all groups have the same sizes.
+    for length in range(0, 20000, 60):
+        sizes = [[960], [960], [960]]
+        assert sound.stretch_counts(sizes, length) == \
+            greedy_counts(sizes, length)